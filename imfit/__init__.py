@@ -17,4 +17,5 @@ if not _ASTROPY_SETUP_:
     from .fitting import *
     from .psf import *
     from .config import *
+    from .tuning import *
     from .lib import *
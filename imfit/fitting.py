@@ -3,11 +3,20 @@ Created on Sep 20, 2013
 
 @author: andre
 '''
-from .model import ModelDescription
+from .model import ModelDescription, ParameterDescription
+from .solvers import differential_evolution, levenberg_marquardt
+from .tuning import autotune, tuned_settings
 import numpy as np
 from copy import deepcopy
+from collections import OrderedDict
+from multiprocessing import cpu_count
+import hashlib
+import time
+import os
 
-__all__ = ['Imfit']
+__all__ = ['Imfit', 'FitResult', 'FitStats']
+
+default_chunk_size = 8
 
         
 ################################################################################
@@ -30,6 +39,45 @@ def _composemask(arr, mask, mask_zero_is_bad):
 ################################################################################
 
 
+################################################################################
+def _maskinvalid(image, error, mask, mask_zero_is_bad):
+    '''
+    Helper function to mask the non-finite pixels of image and error,
+    replacing them by finite values. Always returns a mask array.
+    The input arrays are not modified.
+    '''
+    bad = ~np.isfinite(image) | ~np.isfinite(error)
+    if mask is None:
+        mask = np.zeros(image.shape, dtype='bool')
+        if mask_zero_is_bad:
+            mask = ~mask
+    if bad.any():
+        image = np.where(bad, 0.0, image)
+        error = np.where(bad, 1.0, error)
+        if mask_zero_is_bad:
+            mask = mask & ~bad
+        else:
+            mask = mask | bad
+    return image, error, mask
+################################################################################
+
+
+################################################################################
+def _popkwargs(kwargs, names):
+    '''
+    Helper function to move the keyword arguments in ``names``
+    from ``kwargs`` to a new dictionary, dropping the ones set to ``None``.
+    '''
+    popped = {}
+    for kw in names:
+        if kw in kwargs:
+            value = kwargs.pop(kw)
+            if value is not None:
+                popped[kw] = value
+    return popped
+################################################################################
+
+
 ################################################################################
 class Imfit(object):
     '''
@@ -42,6 +90,10 @@ class Imfit(object):
     On the other hand, one instance can be used to fit the same model
     to any number of images, or to fit and then create the model image.
     
+    Functions whose parameters are all fixed, X0 and Y0 included, are
+    computed and convolved only once when the data is loaded, and added
+    to the model images computed during the fits.
+    
     Parameters
     ----------
     model_descr : :class:`ModelDescription`
@@ -57,30 +109,61 @@ class Imfit(object):
         Default: ``True``.
         
     nproc : int, optional
-        Number of processors to use when fitting. If `None``,
-        use all available processors.
-        Default: ``None`` (use all processors).
+        Number of processors to use when fitting. If `None``, use the
+        value found by :func:`~imfit.autotune` for this model and image
+        shape, or all available processors if not tuned.
+        Default: ``None``.
+        
+    chunk_size : int, optional
+        OpenMP chunk size used when computing the model image. If
+        ``None``, use the value found by :func:`~imfit.autotune`,
+        or ``8`` if not tuned.
+        Default: ``None``.
         
     subsampling : bool, optional
         Use pixel subsampling near center.
         Default: ``True``.
         
+    persistent : bool, optional
+        Keep the underlying model object between calls to :meth:`fit`.
+        Successive fits to images of the same shape, with an error image
+        and the same keyword arguments, only replace the pixel data,
+        reusing the functions, parameter info and PSF convolution setup.
+        The parameters always start from the template model.
+        Default: ``False``.
+        
+    cache_size : int, optional
+        Maximum size in bytes of the cache of model images computed by
+        :meth:`getModelImage` for given parameters. When full, the least
+        recently used images are discarded.
+        Default: ``0`` (no cache).
+        
+    incremental : bool, optional
+        Keep the image of each function of the model, and compute only
+        the functions whose parameters changed when evaluating the model.
+        Speeds up the solvers for models with many functions, for
+        instance many point sources, since most of the evaluations
+        change only one parameter. Uses an extra image per function.
+        Default: ``False``.
+        
     See also
     --------
     parse_config_file, fit
     '''
     
-    def __init__(self, model_descr, psf=None, quiet=True, nproc=None, chunk_size=8, subsampling=True):
+    def __init__(self, model_descr, psf=None, quiet=True, nproc=None, chunk_size=None, subsampling=True,
+                 persistent=False, cache_size=0, incremental=False):
         if not isinstance(model_descr, ModelDescription):
             raise ValueError('model_descr must be a ModelDescription object.')
         self._modelDescr = model_descr
         self._psf = psf
         self._mask = None
         self._modelObject = None
+        self._autoNproc = nproc is None
         if nproc is None:
-            self._nproc = nproc
-        else:
             self._nproc = 0
+        else:
+            self._nproc = nproc
         self._chunkSize = chunk_size
         if quiet:
             self._debugLevel = 0
@@ -89,6 +172,29 @@ class Imfit(object):
             self._debugLevel = 1 if quiet else 1
             self._verboseLevel = 1
         self._subsampling = subsampling
+        self._persistent = persistent
+        self._incremental = incremental
+        self._loadKwargs = None
+        self._cancelRequested = False
+        self._executor = None
+        self._workerModelObjects = None
+        self._clones = []
+        self._threadPool = None
+        self._threadPoolSize = 0
+        self._multistartParameters = None
+        self._multistartFitStatistics = None
+        self._stats = None
+        self._coordinateOffset = (0, 0)
+        self._renderer = None
+        self._rendererKey = None
+        self._batchRenderers = []
+        self._batchRenderersKey = None
+        self._imageCache = _ModelImageCache(cache_size) if cache_size > 0 else None
+        if psf is None:
+            self._psfDigest = None
+        else:
+            psf = np.ascontiguousarray(psf, dtype='float64')
+            self._psfDigest = (psf.shape, hashlib.sha1(psf.tobytes()).hexdigest())
 
 
     def getModelDescription(self):
@@ -118,23 +224,95 @@ class Imfit(object):
         return np.array(self._modelObject.getRawParameters())
 
 
-    def _setupModel(self):
-        from .lib import ModelObjectWrapper
-
+    def _setupModel(self, shape=None, offset=(0, 0)):
         if self._modelObject is not None:
             # FIXME: Find a better way to free cython resources.
             self._modelObject.close()
-        self._modelObject = ModelObjectWrapper(self._modelDescr, self._debugLevel,
-                                               self._verboseLevel, self._subsampling)
+        self._modelObject = self._newModelObject(shape=shape, offset=offset)
+        self._closeClones()
+        
+        
+    def _newModelObject(self, nproc=None, shape=None, model_descr=None, offset=(0, 0)):
+        from .lib import ModelObjectWrapper
+
+        if model_descr is None:
+            model_descr = self._modelDescr
+        model_object = ModelObjectWrapper(model_descr, self._debugLevel,
+                                          self._verboseLevel, self._subsampling)
         if self._psf is not None:
-            self._modelObject.setPSF(np.asarray(self._psf))
-        if self._nproc > 0:
-            self._modelObject.setMaxThreads(self._nproc)
-        if self._chunkSize > 0:
-            self._modelObject.setChunkSize(self._chunkSize)
+            model_object.setPSF(np.asarray(self._psf))
+        if tuple(offset) != (0, 0):
+            model_object.setCoordinateOffset(*offset)
+        nproc, chunk_size = self._threadSettings(nproc, shape)
+        if nproc > 0:
+            model_object.setMaxThreads(nproc)
+        if chunk_size > 0:
+            model_object.setChunkSize(chunk_size)
+        if self._incremental:
+            model_object.setIncremental(True)
+        return model_object
+    
+    
+    def _threadSettings(self, nproc, shape):
+        '''
+        Number of threads and chunk size for images of ``shape``. Settings
+        not given by the user come from the autotuning cache, if available.
+        An explicit ``nproc`` overrides the instance setting.
+        '''
+        chunk_size = self._chunkSize
+        auto_nproc = nproc is None and self._autoNproc
+        if shape is not None and (auto_nproc or chunk_size is None):
+            tuned = tuned_settings(self._modelDescr, shape, self._psf, self._subsampling)
+            if tuned is not None:
+                if auto_nproc:
+                    nproc = tuned[0]
+                if chunk_size is None:
+                    chunk_size = tuned[1]
+        if nproc is None:
+            nproc = self._nproc
+        if chunk_size is None:
+            chunk_size = default_chunk_size
+        return nproc, chunk_size
+    
+    
+    def autotune(self, shape, **kwargs):
+        '''
+        Find the number of threads and chunk size that compute the model
+        image fastest for images of ``shape``, and store them in the
+        autotuning cache. They are used by this and any other instance
+        whose ``nproc`` or ``chunk_size`` are not set, for the same
+        functions, image shape, PSF shape and subsampling.
+        
+        Parameters
+        ----------
+        shape : tuple
+            Shape of the images, in (Y, X) format.
             
+        Keyword arguments are passed to :func:`~imfit.autotune`.
+        
+        Returns
+        -------
+        settings : tuple
+            The tuple ``(nproc, chunk_size)``.
+        '''
+        settings, _ = autotune(self._modelDescr, shape, self._psf, self._subsampling, **kwargs)
+        if self._modelObject is not None and self._modelObject.imageShape == tuple(shape):
+            nproc, chunk_size = self._threadSettings(None, shape)
+            if nproc > 0:
+                self._modelObject.setMaxThreads(nproc)
+            self._modelObject.setChunkSize(chunk_size)
+        return settings
+            
+    
+    def _canReuseModel(self, image, error, kwargs):
+        if self._modelObject is None:
+            return False
+        if error is None or kwargs != self._loadKwargs:
+            return False
+        return self._modelObject.reloadable and self._modelObject.imageShape == image.shape
+
     
-    def fit(self, image, error=None, mask=None, mode='LM', **kwargs):
+    def fit(self, image, error=None, mask=None, mode='LM', copy=True, **kwargs):
         '''
         Fit the model to ``image``, using the inverse of ``noise`` as weight,
         optionally masking some pixels.
@@ -161,6 +339,27 @@ class Imfit(object):
                 * ``'LM'`` : Levenberg-Marquardt least squares.
                 * ``'DE'`` : Differential Evolution.
                 * ``'NM'`` : Nelder-Mead Simplex.
+                * ``'LM-multistart'`` : Levenberg-Marquardt least squares
+                  started from several points inside the parameter limits,
+                  run in parallel threads. The best fit is kept, and all
+                  the solutions are available in :attr:`multistartParameters`
+                  and :attr:`multistartFitStatistics`.
+                * ``'DE-parallel'`` : Differential Evolution, evaluating the
+                  members of the population concurrently in independent
+                  model objects, in parallel threads.
+                * ``'LM-parallel'`` : Levenberg-Marquardt least squares,
+                  computing the columns of the finite-difference Jacobian
+                  concurrently in independent model objects, in parallel
+                  threads. Useful for models with many free parameters.
+                
+        copy : bool, optional
+            If ``False``, a C-contiguous ``float64`` image is used directly
+            by the library instead of being copied, saving memory for large
+            images. Masked arrays and other types are still converted. The
+            error and mask are always copied, as the library rewrites them
+            as weights and mask flags. The image must not be modified while
+            this instance uses it, that is, until the next fit.
+            Default: ``True``.
             
         Keyword arguments
         -----------------
@@ -205,11 +404,561 @@ class Imfit(object):
             chi^2 computation. Takes precedence over ``error``.
             Default: ``False``
             
+        region : tuple
+            Fit only the subsection ``image[y0:y1, x0:x1]`` given by
+            ``(y0, y1, x0, x1)``, in pixels. Only this window of ``image``,
+            ``error`` and ``mask`` is read, so they can be large memory-mapped
+            arrays. The parameters (X0 and Y0 included) are given and reported
+            in the coordinates of the full image, but the model image
+            (see :meth:`getModelImage`) covers only the region.
+            Default: ``None`` (fit the whole image).
+            
+        max_time : float
+            Maximum wall time of the solver, in seconds. When exceeded,
+            the fit is stopped keeping the best parameters found, and
+            flagged with :attr:`fitBudgetExceeded` and :attr:`fitTerminated`.
+            Default: ``None`` (no limit).
+            
+        max_fev : integer
+            Maximum number of model evaluations by the solver, see ``max_time``.
+            Default: ``None`` (no limit).
+            
+        callback : callable
+            Called during the fit as ``callback(params, fitstat, n_evaluations)``,
+            with the raw parameter vector and fit statistic of the current model
+            evaluation and the number of evaluations so far. For ``'DE-parallel'``
+            it gets the best parameters of the last generation evaluated, and
+            for ``'LM-parallel'`` the best ones of the last Jacobian or step.
+            Returning ``True`` stops the fit as :meth:`cancel` does. Not
+            available for ``'LM-multistart'``.
+            Default: ``None``.
+            
+        callback_interval : integer
+            Call ``callback`` every ``callback_interval`` model evaluations.
+            The solvers only take the GIL when the callback is due, so use
+            coarse intervals for fast models.
+            Default: 1
+            
+        n_starts : integer
+            Number of starting points for ``'LM-multistart'``,
+            including the template model.
+            Default: 16
+            
+        workers : integer
+            Number of threads for ``'LM-multistart'``, ``'DE-parallel'``
+            and ``'LM-parallel'``.
+            Default: ``None`` (use all processors).
+            
+        seed : integer
+            Random seed for ``'LM-multistart'`` and ``'DE-parallel'``.
+            Default: ``None``.
+            
         Examples
         --------
         TODO: Examples of fit().
         
         '''
+        self._cancelRequested = False
+        self._stats = FitStats()
+        image, error, mask = self._cutRegion(image, error, mask, kwargs.pop('region', None))
+        if mode == 'LM-multistart':
+            multistart_kw = _popkwargs(kwargs, ['n_starts', 'workers', 'seed'])
+            self._checkFitArgs('LM', kwargs)
+            self._fitMultistart(image, error, mask, kwargs, **multistart_kw)
+            return
+        solver_kw = _popkwargs(kwargs, ['max_time', 'max_fev', 'callback', 'callback_interval'])
+        if mode == 'DE-parallel':
+            solver_kw.update(_popkwargs(kwargs, ['workers', 'seed']))
+            self._checkFitArgs('DE', kwargs)
+            t1 = time.time()
+            self._loadData(image, error, mask, True, kwargs, self._persistent)
+            self._getClones(solver_kw.get('workers') or cpu_count())
+            self._stats.loadTime = time.time() - t1
+            self._fitParallelDE(**solver_kw)
+            return
+        if mode == 'LM-parallel':
+            solver_kw.update(_popkwargs(kwargs, ['workers']))
+            self._checkFitArgs('LM', kwargs)
+            t1 = time.time()
+            self._loadData(image, error, mask, True, kwargs, self._persistent)
+            self._getClones(solver_kw.get('workers') or cpu_count())
+            self._stats.loadTime = time.time() - t1
+            self._fitParallelLM(**solver_kw)
+            return
+        self._checkFitArgs(mode, kwargs)
+        t1 = time.time()
+        self._loadData(image, error, mask, copy, kwargs, self._persistent)
+        self._stats.loadTime = time.time() - t1
+        self._runFit(mode, solver_kw)
+        
+        
+    def _runFit(self, mode, solver_kw):
+        # Drop a cancel requested while no fit was running,
+        # a pending one in this instance is applied again.
+        self._modelObject.clearCancel()
+        if self._cancelRequested:
+            self._modelObject.cancel()
+        self._modelObject.resetStats()
+        try:
+            self._modelObject.fit(verbose=self._verboseLevel, mode=mode, **solver_kw)
+        finally:
+            self._stats._add(self._modelObject)
+        
+        
+    def loadData(self, image, error=None, mask=None, copy=True, **kwargs):
+        '''
+        Load the data without fitting, to be used by :meth:`loglike`
+        and :meth:`evaluateGrid`. The parameters are set to the template
+        model. The arguments are the same as in :meth:`fit`, ``region``
+        included.
+        '''
+        image, error, mask = self._cutRegion(image, error, mask, kwargs.pop('region', None))
+        self._checkFitArgs('LM', kwargs)
+        self._loadData(image, error, mask, copy, kwargs, self._persistent)
+        
+        
+    def loglike(self, params, workers=None):
+        '''
+        Log-likelihood of the loaded data for each parameter vector, for use
+        with external samplers. It is computed from the fit statistic as
+        ``-fitstat / 2``, up to a constant. The model description and the
+        fit results are not changed.
+        
+        Parameters
+        ----------
+        params : array
+            Raw parameter values (see :meth:`getRawParameters`), one vector per
+            row. Values of tied parameters are ignored.
+            
+        workers : int, optional
+            Number of threads evaluating the vectors in parallel, each one with
+            its own copy of the data. If ``None``, the vectors are evaluated
+            one by one, each using ``nproc`` threads.
+            Default: ``None``.
+            
+        Returns
+        -------
+        loglike : array or float
+            Log-likelihood of each vector, or a float if ``params`` is 1-D.
+        '''
+        if self._modelObject is None or self._modelObject.imageShape is None:
+            raise Exception('No data loaded, call fit() or loadData() first.')
+        params = np.asarray(params, dtype='float64')
+        single = params.ndim == 1
+        params = np.ascontiguousarray(np.atleast_2d(params))
+        if workers is None or workers == 1:
+            fitstats = np.empty(len(params))
+            self._modelObject.computeFitStatistics(params, fitstats)
+        else:
+            fitstats = self._parallelFitStatistics(params, workers)
+        loglike = -0.5 * fitstats
+        if single:
+            return loglike[0]
+        return loglike
+        
+        
+    def evaluateGrid(self, parameters, values, profile=False, workers=None, fit=False, mode='LM',
+                     **kwargs):
+        '''
+        Compute the fit statistic of the loaded data on a grid of values of
+        some parameters, for example to find a starting point for a fit.
+        
+        Parameters
+        ----------
+        parameters : list
+            The parameters of the grid, as :class:`ParameterDescription`
+            instances of the template model, or indices of the raw parameters.
+            
+        values : list of arrays or 2-D array
+            Either a list with the values of each parameter, to evaluate on
+            their Cartesian product, or an array of shape
+            ``(n_points, len(parameters))`` with the grid points.
+            
+        profile : bool, optional
+            If ``True``, the other free parameters are fitted at each grid
+            point using Levenberg-Marquardt, starting from the current values.
+            Otherwise they are kept at the current values (the fitted model,
+            or the template model after :meth:`loadData`).
+            Default: ``False``.
+            
+        workers : int, optional
+            Number of threads evaluating grid points in parallel, each one with
+            its own copy of the data. If ``None``, use one thread without
+            ``profile``, and all processors with ``profile``.
+            Default: ``None``.
+            
+        fit : bool, optional
+            If ``True``, fit the model starting from the best grid point
+            (with the profiled values of the other parameters), as
+            :meth:`fit` would.
+            Default: ``False``.
+            
+        mode : string, optional
+            Algorithm used when ``fit`` is ``True``: ``'LM'``, ``'DE'`` or ``'NM'``.
+            Default: ``'LM'``.
+            
+        Keyword arguments
+        -----------------
+        The solver arguments of :meth:`fit` (``max_time``, ``max_fev``,
+        ``callback``, ``callback_interval``), used when ``fit`` is ``True``.
+        
+        Returns
+        -------
+        fitstat : array
+            Fit statistic at each grid point, with shape ``(len(values[0]),
+            len(values[1]), ...)`` for a Cartesian grid, or ``(n_points,)``.
+            Failed profile fits are set to ``inf``.
+        '''
+        if self._modelObject is None or self._modelObject.imageShape is None:
+            raise Exception('No data loaded, call fit() or loadData() first.')
+        self._cancelRequested = False
+        if fit and mode not in ['LM', 'DE', 'NM']:
+            raise Exception('Invalid fit mode: %s' % mode)
+        solver_kw = _popkwargs(kwargs, ['max_time', 'max_fev', 'callback', 'callback_interval'])
+        if len(kwargs) > 0:
+            raise Exception('Unknown kwarg: %s' % list(kwargs.keys())[0])
+        param_list = self._modelDescr.parameterList()
+        index = dict((id(p), i) for i, p in enumerate(param_list))
+        columns = []
+        for p in parameters:
+            if isinstance(p, ParameterDescription):
+                if id(p) not in index:
+                    raise ValueError('Parameter %s is not in the template model.' % p.name)
+                columns.append(index[id(p)])
+            else:
+                columns.append(int(p))
+        
+        if isinstance(values, np.ndarray) and values.ndim == 2:
+            grid_shape = (len(values),)
+            grid_points = np.asarray(values, dtype='float64')
+        else:
+            grid_shape = tuple(len(v) for v in values)
+            mesh = np.meshgrid(*values, indexing='ij')
+            grid_points = np.array([m.ravel() for m in mesh], dtype='float64').T
+        if grid_points.shape[1] != len(columns):
+            raise ValueError('Grid points must have one value for each parameter.')
+        points = np.empty((len(grid_points), len(param_list)))
+        points[:] = self.getRawParameters()
+        points[:, columns] = grid_points
+        
+        if profile:
+            fitstats = self._profileGrid(points, columns, workers)
+        elif workers is None or workers == 1:
+            fitstats = np.empty(len(points))
+            self._modelObject.computeFitStatistics(points, fitstats)
+        else:
+            fitstats = self._parallelFitStatistics(points, workers)
+        
+        if fit:
+            self._stats = FitStats()
+            self._modelObject.setRawParameters(points[np.argmin(fitstats)])
+            self._runFit(mode, solver_kw)
+        return fitstats.reshape(grid_shape)
+    
+    
+    def _profileGrid(self, points, columns, workers):
+        '''
+        Fit the free parameters not in ``columns`` at each point, in place.
+        '''
+        image, error, mask, kwargs = self._loadedData()
+        model_descr = deepcopy(self._modelDescr)
+        profile_params = model_descr.parameterList()
+        for i in columns:
+            profile_params[i].fixed = True
+        if workers is None:
+            workers = cpu_count()
+        workers = max(1, min(workers, len(points)))
+        nproc = self._nproc if self._nproc > 0 else max(1, cpu_count() // workers)
+        fitstats = np.empty(len(points))
+        
+        def fit_points(w):
+            model_object = self._newModelObject(nproc, image.shape, model_descr,
+                                                self._coordinateOffset)
+            try:
+                model_object.loadData(image, error, mask, **kwargs)
+                for i in range(w, len(points), workers):
+                    if self._cancelRequested:
+                        fitstats[i::workers] = np.inf
+                        break
+                    model_object.setRawParameters(points[i])
+                    model_object.fit(verbose=-1, mode='LM')
+                    points[i] = model_object.getRawParameters()
+                    if model_object.fitError:
+                        fitstats[i] = np.inf
+                    else:
+                        fitstats[i] = model_object.getFitStatistic()
+            finally:
+                model_object.close()
+        
+        self._parallelMap(fit_points, range(workers), workers)
+        return fitstats
+        
+        
+    def _fitMultistart(self, image, error, mask, kwargs, n_starts=16, workers=None, seed=None):
+        from multiprocessing.pool import ThreadPool
+        
+        t1 = time.time()
+        image, error, mask = self._prepareData(image, error, mask, kwargs, False)
+        starts = self._drawStarts(n_starts, seed)
+        if workers is None:
+            workers = cpu_count()
+        workers = min(workers, n_starts)
+        nproc = self._nproc if self._nproc > 0 else max(1, cpu_count() // workers)
+        model_objects = [self._newModelObject(nproc, image.shape, offset=self._coordinateOffset)
+                         for _ in range(workers)]
+        for model_object in model_objects:
+            model_object.loadData(image, error, mask, **kwargs)
+            model_object.resetStats()
+        self._workerModelObjects = model_objects
+        self._stats.loadTime = time.time() - t1
+        
+        params = np.empty((n_starts, len(starts[0])))
+        fitstats = np.empty(n_starts)
+        last_start = [None] * workers
+        
+        def run_starts(w):
+            # The solvers release the GIL, so the threads run concurrently.
+            model_object = model_objects[w]
+            for i in range(w, n_starts, workers):
+                if self._cancelRequested:
+                    model_object.cancel()
+                model_object.setRawParameters(starts[i])
+                model_object.fit(verbose=self._verboseLevel, mode='LM')
+                params[i] = model_object.getRawParameters()
+                if model_object.fitError:
+                    fitstats[i] = np.inf
+                else:
+                    fitstats[i] = model_object.getFitStatistic()
+                last_start[w] = i
+        
+        pool = ThreadPool(workers)
+        try:
+            pool.map(run_starts, range(workers))
+            pool.close()
+            pool.join()
+        finally:
+            pool.terminate()
+            self._workerModelObjects = None
+        
+        best = int(np.argmin(fitstats))
+        w = best % workers
+        best_model_object = model_objects[w]
+        if last_start[w] != best:
+            # Redo the best fit, to keep its status in the model object.
+            best_model_object.setRawParameters(starts[best])
+            best_model_object.fit(verbose=self._verboseLevel, mode='LM')
+        for model_object in model_objects:
+            self._stats._add(model_object)
+        for model_object in model_objects:
+            if model_object is not best_model_object:
+                model_object.close()
+        if self._modelObject is not None:
+            self._modelObject.close()
+        self._modelObject = best_model_object
+        self._loadKwargs = kwargs
+        self._closeClones()
+        self._multistartParameters = params
+        self._multistartFitStatistics = fitstats
+        
+        
+    def _fitParallelDE(self, workers=None, seed=None, max_time=0.0, max_fev=0,
+                       callback=None, callback_interval=1):
+        if workers is None:
+            workers = cpu_count()
+        deadline = time.time() + max_time if max_time > 0 else None
+        n_fev = [0]
+        next_callback = [callback_interval]
+        budget_exceeded = [False]
+        param_list = self._modelDescr.parameterList()
+        x0 = np.array([p.value for p in param_list])
+        free = np.array([not p.fixed and p.tied is None for p in param_list])
+        lower = np.array([p.limits[0] if p.limits is not None else -np.inf for p in param_list])
+        upper = np.array([p.limits[1] if p.limits is not None else np.inf for p in param_list])
+        
+        def evaluate(params):
+            n_fev[0] += len(params)
+            fitstats = self._parallelFitStatistics(params, workers)
+            if callback is not None and n_fev[0] >= next_callback[0]:
+                next_callback[0] = n_fev[0] + callback_interval
+                best = np.argmin(fitstats)
+                if callback(params[best].copy(), fitstats[best], n_fev[0]):
+                    self._cancelRequested = True
+            return fitstats
+        
+        def stop():
+            # Checked once per generation.
+            if (max_fev > 0 and n_fev[0] >= max_fev) or \
+               (deadline is not None and time.time() >= deadline):
+                budget_exceeded[0] = True
+            return self._cancelRequested or budget_exceeded[0]
+
+        clones = self._getClones(workers)
+        for model_object in clones:
+            model_object.resetStats()
+        t1 = time.time()
+        params, _, _, status = differential_evolution(evaluate, x0, lower, upper, free,
+                                                      seed=seed, stop=stop)
+        self._modelObject.setFitResult(params, status, 'DE-parallel',
+                                       cancelled=self._cancelRequested,
+                                       budget_exceeded=budget_exceeded[0],
+                                       n_fev=n_fev[0])
+        for model_object in clones:
+            self._stats._add(model_object)
+        self._stats.solverTime = time.time() - t1
+        self._stats.nFev = n_fev[0]
+        
+        
+    def _fitParallelLM(self, workers=None, max_time=0.0, max_fev=0,
+                       callback=None, callback_interval=1):
+        if workers is None:
+            workers = cpu_count()
+        deadline = time.time() + max_time if max_time > 0 else None
+        n_fev = [0]
+        next_callback = [callback_interval]
+        budget_exceeded = [False]
+        param_list = self._modelDescr.parameterList()
+        x0 = np.array([p.value for p in param_list])
+        free = np.array([not p.fixed and p.tied is None for p in param_list])
+        lower = np.array([p.limits[0] if p.limits is not None else -np.inf for p in param_list])
+        upper = np.array([p.limits[1] if p.limits is not None else np.inf for p in param_list])
+        
+        def deviates(params):
+            n_fev[0] += len(params)
+            out = self._parallelDeviates(params, workers)
+            if callback is not None and n_fev[0] >= next_callback[0]:
+                next_callback[0] = n_fev[0] + callback_interval
+                chi2 = (out * out).sum(axis=1)
+                best = np.argmin(chi2)
+                if callback(params[best].copy(), chi2[best], n_fev[0]):
+                    self._cancelRequested = True
+            return out
+        
+        def stop():
+            # Checked once per iteration.
+            if (max_fev > 0 and n_fev[0] >= max_fev) or \
+               (deadline is not None and time.time() >= deadline):
+                budget_exceeded[0] = True
+            return self._cancelRequested or budget_exceeded[0]
+
+        clones = self._getClones(workers)
+        for model_object in clones:
+            model_object.resetStats()
+        t1 = time.time()
+        params, _, n_iter, status = levenberg_marquardt(deviates, x0, lower, upper, free,
+                                                        stop=stop)
+        self._modelObject.setFitResult(params, status, 'LM-parallel',
+                                       cancelled=self._cancelRequested,
+                                       budget_exceeded=budget_exceeded[0],
+                                       n_fev=n_fev[0], n_iter=n_iter)
+        for model_object in clones:
+            self._stats._add(model_object)
+        self._stats.solverTime = time.time() - t1
+        self._stats.nFev = n_fev[0]
+        
+        
+    def bootstrap(self, n_iter, workers=None, mode='LM', seed=None):
+        '''
+        Estimate the distribution of the parameters by bootstrap
+        resampling of the pixels of the last fitted image.
+        
+        Each iteration draws the valid pixels with replacement, which
+        amounts to scaling the weight of each pixel by the number of
+        times it was drawn, and refits the model starting from the
+        current best-fit parameters. The iterations run in parallel
+        threads sharing one copy of the image, each thread reusing one
+        model object for all its iterations.
+        
+        Parameters
+        ----------
+        n_iter : int
+            Number of bootstrap iterations.
+            
+        workers : int, optional
+            Number of threads.
+            Default: ``None`` (use all processors).
+            
+        mode : string, optional
+            Fit algorithm, see :meth:`fit`.
+            Default: ``'LM'``.
+        
+        seed : int, optional
+            Random seed. Default: ``None``.
+            
+        Returns
+        -------
+        samples : 2-D array
+            Array of shape ``(n_iter, n_params)`` with the parameters
+            fitted in each iteration, in the same order as
+            :meth:`getRawParameters`.
+        '''
+        image, weight, mask, kwargs = self._loadedData()
+        if weight is None or kwargs.get('use_cash_statistics') or kwargs.get('use_model_for_errors'):
+            raise Exception('Bootstrap requires a fit using an error image.')
+        mask_zero_is_bad = kwargs.get('mask_format') == 'zero_is_bad'
+        if workers is None:
+            workers = cpu_count()
+        workers = min(workers, n_iter)
+        
+        good = np.isfinite(image) & np.isfinite(weight)
+        if mask is not None:
+            good &= (mask != 0) if mask_zero_is_bad else (mask == 0)
+        # Reloaded data is not checked by the library.
+        image = np.where(good, image, 0.0)
+        weight = np.where(good, weight, 1.0)
+        good_pixels = np.flatnonzero(good)
+        best_params = self.getRawParameters()
+        seeds = np.random.RandomState(seed).randint(0, 2**31 - 1, n_iter)
+        samples = np.empty((n_iter, len(best_params)))
+        
+        def run_iterations(w):
+            model_object = None
+            try:
+                for i in range(w, n_iter, workers):
+                    rng = np.random.RandomState(seeds[i])
+                    drawn = rng.randint(0, len(good_pixels), len(good_pixels))
+                    counts = np.zeros(image.size)
+                    counts[good_pixels] = np.bincount(drawn, minlength=len(good_pixels))
+                    counts = counts.reshape(image.shape)
+                    # Each draw of a pixel adds its weight.
+                    boot_weight = weight * counts
+                    if mask_zero_is_bad:
+                        boot_mask = (counts > 0).astype('float64')
+                    else:
+                        boot_mask = (counts == 0).astype('float64')
+                    if model_object is None:
+                        model_object = self._newModelObject(1, image.shape,
+                                                            offset=self._coordinateOffset)
+                        model_object.loadData(image, boot_weight, boot_mask, copy=False, **kwargs)
+                    else:
+                        model_object.reloadData(image, boot_weight, boot_mask)
+                    model_object.setRawParameters(best_params)
+                    model_object.fit(verbose=-1, mode=mode)
+                    samples[i] = model_object.getRawParameters()
+            finally:
+                if model_object is not None:
+                    model_object.close()
+        
+        self._parallelMap(run_iterations, range(workers), workers)
+        return samples
+        
+        
+    def _drawStarts(self, n_starts, seed):
+        '''
+        Starting points for the multistart fit. The first one is the
+        template model, the others are drawn uniformly inside the limits
+        of the free parameters. Parameters without limits are not changed.
+        '''
+        rng = np.random.RandomState(seed)
+        param_list = self._modelDescr.parameterList()
+        starts = np.empty((n_starts, len(param_list)))
+        for j, p in enumerate(param_list):
+            starts[:, j] = p.value
+            if not p.fixed and p.tied is None and p.limits is not None:
+                starts[1:, j] = rng.uniform(p.limits[0], p.limits[1], n_starts - 1)
+        return starts
+        
+        
+    def _checkFitArgs(self, mode, kwargs):
         if mode not in ['LM', 'DE', 'NM']:
             raise Exception('Invalid fit mode: %s' % mode)
         all_kw = ['n_combined', 'exp_time', 'gain', 'read_noise', 'original_sky',
@@ -217,14 +966,140 @@ class Imfit(object):
         for kw in kwargs.keys():
             if kw not in all_kw:
                 raise Exception('Unknown kwarg: %s' % kw)
-        mask_zero_is_bad = 'mask_format' in kwargs and kwargs['mask_format'] == 'zero_is_bad'
-
-        self._setupModel()
         
+        
+    def _loadData(self, image, error, mask, copy, kwargs, persistent):
+        image, error, mask = self._prepareData(image, error, mask, kwargs, persistent)
+        if persistent and copy and self._canReuseModel(image, error, kwargs):
+            self._modelObject.setCoordinateOffset(*self._coordinateOffset)
+            self._modelObject.reloadData(image, error, mask)
+            self._closeClones()
+        else:
+            self._setupModel(image.shape, self._coordinateOffset)
+            self._modelObject.loadData(image, error, mask, copy=copy, **kwargs)
+            self._loadKwargs = kwargs
+        
+        
+    def _loadedData(self):
+        '''
+        The data loaded in the model object, to load other model objects
+        with. These are views of the library buffers, so no other
+        references or copies of the input arrays are kept.
+        '''
+        if self._modelObject is None or self._loadKwargs is None:
+            raise Exception('No data available, call fit() or loadData() first.')
+        image, weight, mask = self._modelObject.getLoadedData()
+        kwargs = dict(self._loadKwargs)
+        # Already converted by the library.
+        if weight is not None:
+            kwargs['error_type'] = 'weight'
+        if mask is not None:
+            kwargs['mask_format'] = 'zero_is_bad'
+        return image, weight, mask, kwargs
+        
+        
+    def _getClones(self, n):
+        '''
+        Independent model objects loaded with the data of the last fit,
+        with one thread each, to evaluate the model in parallel.
+        They are kept until new data is loaded.
+        '''
+        if len(self._clones) < n:
+            image, error, mask, kwargs = self._loadedData()
+        while len(self._clones) < n:
+            model_object = self._newModelObject(1, image.shape, offset=self._coordinateOffset)
+            model_object.loadData(image, error, mask, **kwargs)
+            self._clones.append(model_object)
+        return self._clones[:n]
+    
+    
+    def _closeClones(self):
+        for model_object in self._clones:
+            model_object.close()
+        self._clones = []
+        
+        
+    def _parallelMap(self, func, args, workers):
+        if self._threadPool is None or self._threadPoolSize != workers:
+            from multiprocessing.pool import ThreadPool
+            if self._threadPool is not None:
+                self._threadPool.close()
+            self._threadPool = ThreadPool(workers)
+            self._threadPoolSize = workers
+        return self._threadPool.map(func, args)
+    
+    
+    def _parallelFitStatistics(self, params, workers):
+        '''
+        Fit statistic of each row of ``params``, splitting the rows
+        among ``workers`` model objects evaluated in parallel threads.
+        '''
+        params = np.ascontiguousarray(params, dtype='float64')
+        out = np.empty(len(params))
+        clones = self._getClones(min(workers, len(params)))
+        bounds = np.linspace(0, len(params), len(clones) + 1).astype('int')
+        
+        def evaluate(k):
+            i1, i2 = bounds[k], bounds[k + 1]
+            clones[k].computeFitStatistics(params[i1:i2], out[i1:i2])
+        
+        self._parallelMap(evaluate, range(len(clones)), len(clones))
+        return out
+        
+        
+    def _parallelDeviates(self, params, workers):
+        '''
+        Weighted deviates of each row of ``params``, splitting the rows
+        among ``workers`` model objects evaluated in parallel threads.
+        '''
+        params = np.ascontiguousarray(params, dtype='float64')
+        clones = self._getClones(min(workers, len(params)))
+        out = np.empty((len(params), clones[0].imageShape[0] * clones[0].imageShape[1]))
+        bounds = np.linspace(0, len(params), len(clones) + 1).astype('int')
+        
+        def evaluate(k):
+            i1, i2 = bounds[k], bounds[k + 1]
+            clones[k].computeDeviates(params[i1:i2], out[i1:i2])
+        
+        if len(clones) == 1:
+            # The L-M steps, no need to resize the thread pool.
+            evaluate(0)
+        else:
+            self._parallelMap(evaluate, range(len(clones)), len(clones))
+        return out
+        
+        
+    def _cutRegion(self, image, error, mask, region):
+        '''
+        Slice the fitted region from the input arrays, without copying,
+        and set the offset of the model coordinates.
+        '''
+        if region is None:
+            self._coordinateOffset = (0, 0)
+            return image, error, mask
+        y0, y1, x0, x1 = [int(v) for v in region]
+        n_rows, n_cols = np.shape(image)
+        if error is not None and np.shape(error) != (n_rows, n_cols):
+            raise Exception('Error and image shapes do not match.')
+        if mask is not None and np.shape(mask) != (n_rows, n_cols):
+            raise Exception('Mask and image shapes do not match.')
+        if not (0 <= y0 < y1 <= n_rows and 0 <= x0 < x1 <= n_cols):
+            raise ValueError('Region %s outside of the image.' % (region,))
+        image = image[y0:y1, x0:x1]
+        if error is not None:
+            error = error[y0:y1, x0:x1]
+        if mask is not None:
+            mask = mask[y0:y1, x0:x1]
+        self._coordinateOffset = (x0, y0)
+        return image, error, mask
+    
+    
+    def _prepareData(self, image, error, mask, kwargs, persistent):
+        mask_zero_is_bad = 'mask_format' in kwargs and kwargs['mask_format'] == 'zero_is_bad'
         mask = _composemask(image, mask, mask_zero_is_bad)
         if isinstance(image, np.ma.MaskedArray):
             image = image.filled(fill_value=0.0)
-        image = image.astype('float64')
+        image = np.ascontiguousarray(image, dtype='float64')
 
         if error is not None:
             if image.shape != error.shape:
@@ -232,15 +1107,239 @@ class Imfit(object):
             mask = _composemask(image, mask, mask_zero_is_bad)
             if isinstance(error, np.ma.MaskedArray):
                 error = error.filled(fill_value=error.max())
-            error = error.astype('float64')
+            error = np.ascontiguousarray(error, dtype='float64')
 
         if mask is not None:
             if image.shape != mask.shape:
                 raise Exception('Mask and image shapes do not match.')
-            mask = mask.astype('float64')
+        if persistent and error is not None:
+            # Reloadable models need their own mask buffer.
+            image, error, mask = _maskinvalid(image, error, mask, mask_zero_is_bad)
+        if mask is not None:
+            mask = np.ascontiguousarray(mask, dtype='float64')
+        return image, error, mask
+        
+    
+    def fitSequence(self, images, errors=None, masks=None, mode='LM', warm_start=True,
+                    fallback=True, divergence_factor=2.0, **kwargs):
+        '''
+        Fit the model to a sequence of images, like the slices of a data cube
+        or the epochs of a time series, starting each fit from the
+        best-fit parameters of the previous one.
+        
+        The native model object is kept between the fits as in the
+        ``persistent`` mode, even if this instance was not created with
+        it, when error images are given. After the call, this instance
+        holds the fit of the last image.
+        
+        Parameters
+        ----------
+        images : 3-D array or iterable of 2-D arrays
+            Images to be fitted, in order.
+        
+        errors : 3-D array or sequence of 2-D arrays, optional
+            Error images, one for each image.
+        
+        masks : 3-D array or sequence of 2-D arrays, optional
+            Masks, one for each image.
+            
+        mode : string
+            Fit algorithm, see :meth:`fit`.
+            
+        warm_start : bool, optional
+            Start each fit from the result of the previous one. If ``False``,
+            all the fits start from the template model.
+            Default: ``True``.
+            
+        fallback : bool, optional
+            Refit from the template model when a warm-started fit fails,
+            or when its reduced fit statistic is larger than
+            ``divergence_factor`` times the one of the previous fit.
+            Default: ``True``.
+            
+        divergence_factor : float, optional
+            See ``fallback``. Default: ``2.0``.
+            
+        Keyword arguments
+        -----------------
+        Same as :meth:`fit`, applied to each image, except for the ones
+        specific to ``'LM-multistart'``, ``'DE-parallel'`` and ``'LM-parallel'``.
+        ``max_time`` and ``max_fev`` apply to each fit, and :meth:`cancel`
+        stops only the current fit.
+        
+        Returns
+        -------
+        results : list of :class:`FitResult`
+            The results of each fit. The attribute ``warmStart``
+            tells whether the kept fit started from the previous result.
+        
+        See also
+        --------
+        fit, fit_many
+        '''
+        region = kwargs.pop('region', None)
+        solver_kw = _popkwargs(kwargs, ['max_time', 'max_fev', 'callback', 'callback_interval'])
+        self._checkFitArgs(mode, kwargs)
+        results = []
+        previous = None
+        for i, image in enumerate(images):
+            error = errors[i] if errors is not None else None
+            mask = masks[i] if masks is not None else None
+            self._cancelRequested = False
+            self._stats = FitStats()
+            image, error, mask = self._cutRegion(image, error, mask, region)
+            t1 = time.time()
+            self._loadData(image, error, mask, True, kwargs, True)
+            self._stats.loadTime = time.time() - t1
+            warm = warm_start and previous is not None
+            if warm:
+                self._modelObject.setRawParameters(previous.rawParameters)
+            self._runFit(mode, solver_kw)
+            if warm and fallback and self._diverged(previous, divergence_factor):
+                self._modelObject.resetParameters()
+                self._runFit(mode, solver_kw)
+                warm = False
+            previous = FitResult(self)
+            previous.warmStart = warm
+            results.append(previous)
+        return results
+    
+    
+    def _diverged(self, previous, divergence_factor):
+        if self.fitError or self.fitTerminated:
+            return True
+        return self.reducedFitStatistic > divergence_factor * previous.reducedFitStatistic
+        
+    
+    def fit_async(self, image, error=None, mask=None, mode='LM', executor=None, **kwargs):
+        '''
+        Run :meth:`fit` in the background, returning immediately.
+        
+        The arguments are the same as in :meth:`fit`. Requires the
+        :mod:`concurrent.futures` module (the ``futures`` package
+        in Python 2).
+        
+        Parameters
+        ----------
+        executor : :class:`concurrent.futures.Executor`, optional
+            Executor used to run the fit. It must run the fits of this
+            instance one at a time, so a thread pool is only safe if
+            each :class:`Imfit` instance has at most one fit in flight.
+            Default: ``None``, use a single thread owned by this instance,
+            queueing the fits.
+        
+        Returns
+        -------
+        future : :class:`concurrent.futures.Future`
+            Future resolving to a :class:`FitResult`. Cancelling the future
+            only works for fits not yet started, use :meth:`cancel` to
+            stop a running fit.
+        
+        Examples
+        --------
+        From a coroutine, the future can be awaited with
+        ``result = await asyncio.wrap_future(imfit.fit_async(image, noise))``.
+        
+        See also
+        --------
+        fit, cancel
+        '''
+        if executor is None:
+            if self._executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self._executor = ThreadPoolExecutor(max_workers=1)
+            executor = self._executor
+        return executor.submit(self._fitResult, image, error, mask, mode, kwargs)
+    
+    
+    def _fitResult(self, image, error, mask, mode, kwargs):
+        self.fit(image, error, mask, mode, **kwargs)
+        return FitResult(self)
+        
+    
+    def cancel(self):
+        '''
+        Stop the fit running in another thread, for example one started
+        by :meth:`fit_async`. The solver stops at its next model evaluation,
+        keeping the best parameters found so far, and the fit is flagged
+        with :attr:`fitCancelled`. Has no effect if no fit is running.
+        '''
+        self._cancelRequested = True
+        if self._modelObject is not None:
+            self._modelObject.cancel()
+        model_objects = self._workerModelObjects
+        if model_objects is not None:
+            for model_object in model_objects:
+                model_object.cancel()
+        
+    
+    def fit_many(self, images, errors=None, masks=None, mode='LM', workers=None, ordered=True, **kwargs):
+        '''
+        Fit the model to many images, distributing the fits across
+        worker processes.
+        
+        The model and PSF are sent once to each worker, which keeps a
+        persistent :class:`Imfit` instance (see the ``persistent``
+        argument) and reuses it for every image it receives. Fits
+        with an error image benefit the most from this reuse.
+        This instance is not modified.
+        
+        Parameters
+        ----------
+        images : sequence of 2-D arrays or 3-D array
+            Images to be fitted.
+        
+        errors : sequence of 2-D arrays or 3-D array, optional
+            Error images, one for each image.
+        
+        masks : sequence of 2-D arrays or 3-D array, optional
+            Masks, one for each image.
+            
+        mode : string
+            Fit algorithm, see :meth:`fit`.
+            
+        workers : int, optional
+            Number of worker processes.
+            Default: ``None`` (use all processors).
+            
+        ordered : bool, optional
+            If ``True``, return the results in the same order as ``images``.
+            Otherwise, return an iterator of ``(index, result)`` pairs,
+            in the order the fits are completed.
+            Default: ``True``.
+            
+        Keyword arguments
+        -----------------
+        Same as :meth:`fit`, applied to each image, except for the ones
+        specific to ``'LM-multistart'``, ``'DE-parallel'`` and ``'LM-parallel'``.
+        ``max_time`` and ``max_fev`` apply to each fit, and :meth:`cancel`
+        stops only the current fit.
+        
+        Returns
+        -------
+        results : list of :class:`FitResult`
+            The results of each fit, or an iterator of ``(index, result)``
+            if ``ordered`` is ``False``.
         
-        self._modelObject.loadData(image, error, mask, **kwargs)
-        self._modelObject.fit(verbose=self._verboseLevel, mode=mode)
+        See also
+        --------
+        fit
+        '''
+        if workers is None:
+            workers = cpu_count()
+        if self._nproc > 0:
+            nproc = self._nproc
+        else:
+            # Share the cores among the workers instead of oversubscribing.
+            nproc = max(1, cpu_count() // workers)
+        tasks = _fit_many_tasks(images, errors, masks, mode, kwargs)
+        initargs = (self._modelDescr, self._psf, nproc, self._chunkSize, self._subsampling,
+                    self._incremental)
+        results = _fit_many_iter(tasks, workers, initargs, ordered)
+        if ordered:
+            return [r for _, r in results]
+        else:
+            return results
         
     
     @property
@@ -258,10 +1357,60 @@ class Imfit(object):
         return self._modelObject.fitTerminated
     
     
+    @property
+    def multistartParameters(self):
+        '''
+        Parameters found by each start of the last ``'LM-multistart'``
+        fit, as an array of shape ``(n_starts, n_params)``.
+        '''
+        return self._multistartParameters
+    
+    
+    @property
+    def multistartFitStatistics(self):
+        '''
+        Fit statistic of each start of the last ``'LM-multistart'`` fit,
+        ``inf`` for the failed ones.
+        '''
+        return self._multistartFitStatistics
+    
+    
+    @property
+    def fitCancelled(self):
+        '''
+        ``True`` if the fit was stopped by :meth:`cancel`.
+        '''
+        return self._modelObject.fitCancelled
+    
+    
+    @property
+    def fitBudgetExceeded(self):
+        '''
+        ``True`` if the fit was stopped for exceeding ``max_time`` or ``max_fev``.
+        '''
+        return self._modelObject.fitBudgetExceeded
+    
+    
+    @property
+    def stats(self):
+        '''
+        Performance counters of the last call to :meth:`fit`, an instance
+        of :class:`FitStats`. ``None`` if not fitted yet.
+        '''
+        return self._stats
+    
+    
     @property
     def nIter(self):
         return self._modelObject.nIter
 
+    @property
+    def nFev(self):
+        '''
+        Number of model evaluations of the last fit.
+        '''
+        return self._modelObject.nFev
+
     @property
     def nPegged(self):
         return self._modelObject.nPegged
@@ -304,7 +1453,7 @@ class Imfit(object):
         return self._modelObject.getFitStatistic(mode='BIC')
     
     
-    def getModelImage(self, shape=None):
+    def getModelImage(self, shape=None, out=None, view=False, params=None):
         '''
         Computes an image from the currently fitted model.
         If not fitted, use the template model.
@@ -314,25 +1463,570 @@ class Imfit(object):
         shape : tuple
             Shape of the image in (Y, X) format.
             
+        params : array, optional
+            Raw parameter values (see :meth:`getRawParameters`) to compute
+            the image for, instead of the fitted model. The fit results are
+            not changed. If ``shape`` is not given, use the shape and position
+            of the fitted image (or region), otherwise the image starts at
+            the origin of the coordinates. These images are kept in the cache
+            set by ``cache_size``.
+            Default: ``None``.
+            
+        out : 2-D array, optional
+            Array where the image is written, instead of allocating
+            a new one. Can be a memory-mapped array.
+            Default: ``None``.
+            
+        view : bool, optional
+            Return a read-only view of the library buffer instead of
+            a copy. The view stays valid after this instance is refitted
+            or deleted, but its contents change if the same model object
+            is evaluated again (see the ``persistent`` argument).
+            Default: ``False``.
+            
         Returns
         -------
         image : 2-D array
             Image computed from the current model.
         '''
-        if self._modelObject is None:
-            self._setupModel()
-        if shape is not None:
-            self._modelObject.setupModelImage(shape)
-
-        image = self._modelObject.getModelImage()
+        if params is not None:
+            image = self._renderParameters(params, shape, out, view)
+        else:
+            if self._modelObject is None:
+                self._setupModel(shape)
+            if shape is not None:
+                self._modelObject.setupModelImage(shape)
+            image = self._modelObject.getModelImage(out=out, view=view)
         if self._mask is None:
             return image
         else:
-            return np.ma.array(image, mask=self._mask)
+            return np.ma.array(image, mask=self._mask, copy=False)
+        
+        
+    def _renderParameters(self, params, shape, out, view):
+        params = np.ascontiguousarray(params, dtype='float64')
+        shape, offset = self._renderShape(shape)
+        key = None
+        if self._imageCache is not None:
+            key = (params.tobytes(), shape, offset, self._psfDigest)
+            image = self._imageCache.get(key)
+            if image is not None:
+                if out is not None:
+                    out[...] = image
+                    return out
+                return image if view else image.copy()
+        
+        renderer = self._getRenderer(shape, offset)
+        renderer.createModelImage(params)
+        if key is None:
+            return renderer.getModelImage(out=out, view=view)
+        
+        image = renderer.getModelImage()
+        image.setflags(write=False)
+        self._imageCache.put(key, image)
+        if out is not None:
+            out[...] = image
+            return out
+        return image if view else image.copy()
+    
+    
+    def _renderShape(self, shape):
+        '''
+        Shape and coordinate offset of the rendered images. Without a shape,
+        they are the ones of the loaded image (or region), otherwise the
+        images start at the origin.
+        '''
+        if shape is None:
+            if self._modelObject is None or self._modelObject.imageShape is None:
+                raise Exception('Image shape not set, pass a shape or fit an image first.')
+            return tuple(self._modelObject.imageShape), self._coordinateOffset
+        return tuple(shape), (0, 0)
+    
+    
+    def _getRenderer(self, shape, offset=(0, 0)):
+        '''
+        Model object used to compute images for arbitrary parameters,
+        separate from the fitted one to keep the fit results.
+        '''
+        renderer_key = (shape, offset)
+        if self._renderer is None or self._rendererKey != renderer_key:
+            if self._renderer is not None:
+                self._renderer.close()
+                self._renderer = None
+            self._renderer = self._newModelObject(shape=shape, offset=offset)
+            self._renderer.setupModelImage(shape)
+            self._rendererKey = renderer_key
+        return self._renderer
+    
+    
+    def _getBatchRenderers(self, shape, offset, n):
+        '''
+        Model objects with one thread each, to compute
+        images for many parameters in parallel.
+        '''
+        renderers_key = (shape, offset)
+        if self._batchRenderersKey != renderers_key:
+            self._closeBatchRenderers()
+            self._batchRenderersKey = renderers_key
+        while len(self._batchRenderers) < n:
+            model_object = self._newModelObject(1, shape, offset=offset)
+            model_object.setupModelImage(shape)
+            self._batchRenderers.append(model_object)
+        return self._batchRenderers[:n]
+    
+    
+    def _closeBatchRenderers(self):
+        for model_object in self._batchRenderers:
+            model_object.close()
+        self._batchRenderers = []
+        self._batchRenderersKey = None
+        
+        
+    def render_batch(self, params, shape=None, out=None, workers=None):
+        '''
+        Computes the model images for many parameter vectors at once,
+        reusing the model objects and PSF setup between calls. The
+        fit results are not changed.
+        
+        Parameters
+        ----------
+        params : 2-D array
+            Raw parameter values (see :meth:`getRawParameters`),
+            one vector per row.
+            
+        shape : tuple, optional
+            Shape of the images in (Y, X) format.
+            Default: ``None``, use the shape of the fitted image (or region).
+            
+        out : 3-D array, optional
+            C-contiguous ``float64`` array of shape ``(n_vectors, ny, nx)``
+            where the images are written, instead of allocating a new one.
+            Default: ``None``.
+            
+        workers : int, optional
+            Number of threads computing images in parallel, each one
+            with its own model object. If ``1``, the images are computed
+            one by one, each using ``nproc`` threads.
+            Default: ``None`` (use all processors).
+            
+        Returns
+        -------
+        images : 3-D array
+            The model images, with shape ``(n_vectors, ny, nx)``.
+        '''
+        params = np.ascontiguousarray(np.atleast_2d(params), dtype='float64')
+        shape, offset = self._renderShape(shape)
+        if out is None:
+            out = np.empty((len(params),) + shape, dtype='float64')
+        if workers is None:
+            workers = cpu_count()
+        workers = max(1, min(workers, len(params)))
+        if workers == 1:
+            self._getRenderer(shape, offset).createModelImages(params, out)
+            return out
+        
+        renderers = self._getBatchRenderers(shape, offset, workers)
+        bounds = np.linspace(0, len(params), workers + 1).astype('int')
+        
+        def render(k):
+            i1, i2 = bounds[k], bounds[k + 1]
+            renderers[k].createModelImages(params[i1:i2], out[i1:i2])
+        
+        self._parallelMap(render, range(workers), workers)
+        return out
+    
+    
+    def getComponentImages(self, shape=None, params=None, convolve=True, out=None, as_dict=False):
+        '''
+        Computes the image of each function of the model, in a single pass
+        over the pixels, using the currently fitted model or the template
+        model if not fitted.
+        
+        Parameters
+        ----------
+        shape : tuple, optional
+            Shape of the images in (Y, X) format.
+            Default: ``None``, use the shape of the fitted image (or region).
+            
+        params : array, optional
+            Raw parameter values to compute the images for, instead of
+            the fitted model. See :meth:`getModelImage`.
+            Default: ``None``.
+            
+        convolve : bool, optional
+            Convolve each image with the PSF, if there is one.
+            Default: ``True``.
+            
+        out : 3-D array, optional
+            C-contiguous ``float64`` array of shape ``(n_functions, ny, nx)``
+            where the images are written, instead of allocating a new one.
+            Default: ``None``.
+            
+        as_dict : bool, optional
+            Return a dictionary of images keyed by the function names,
+            prefixed by the function set name if not unique.
+            Default: ``False``.
+            
+        Returns
+        -------
+        images : 3-D array or dict
+            Images of the functions, in the order of the model description.
+            Their sum is the model image.
+        '''
+        if params is None and shape is None and self._modelObject is not None \
+           and self._modelObject.imageShape is not None:
+            model_object = self._modelObject
+        else:
+            if params is None:
+                if self._modelObject is not None:
+                    params = self.getRawParameters()
+                else:
+                    params = np.array([p.value for p in self._modelDescr.parameterList()])
+            model_object = self._getRenderer(*self._renderShape(shape))
+            model_object.setRawParameters(params)
+        images = model_object.getComponentImages(out=out, convolve=convolve)
+        if not as_dict:
+            return images
+        names = _component_names(self._modelDescr)
+        return OrderedDict((name, images[i]) for i, name in enumerate(names))
+    
+    
+    def clearModelImageCache(self):
+        '''
+        Discard the images cached by :meth:`getModelImage`.
+        '''
+        if self._imageCache is not None:
+            self._imageCache.clear()
+        
+        
+    def getModelImageTiled(self, shape, out=None, tile_size=1024, workers=1, overwrite=False):
+        '''
+        Computes an image from the currently fitted model, or the template
+        model if not fitted, tile by tile. The memory used is bounded by the
+        size of the tiles, allowing very large images to be written to a
+        memory-mapped array or a FITS file.
+        
+        When there is a PSF, each tile is computed with a border of the size
+        of the PSF before the convolution, so that the result does not depend
+        on the tiling.
+        
+        Parameters
+        ----------
+        shape : tuple
+            Shape of the image in (Y, X) format.
+            
+        out : 2-D array or string, optional
+            Array where the image is written, such as a :class:`numpy.memmap`.
+            If a string, a FITS file with this name is created and the image
+            is written into it through memory mapping.
+            Default: ``None``, allocate a new array.
+            
+        tile_size : int or tuple, optional
+            Size of the tiles in pixels, in (Y, X) format if a tuple.
+            Default: ``1024``.
+            
+        workers : int, optional
+            Number of tiles computed in parallel threads. If ``None``, use
+            all processors.
+            Default: ``1``.
+            
+        overwrite : bool, optional
+            If ``True``, overwrite the FITS file named by ``out`` if it
+            exists, otherwise raise an :class:`OSError`.
+            Default: ``False``.
+            
+        Returns
+        -------
+        image : 2-D array or string
+            The model image, or the name of the FITS file if ``out`` is a string.
+        '''
+        shape = tuple(shape)
+        if np.isscalar(tile_size):
+            tile_size = (tile_size, tile_size)
+        if workers is None:
+            workers = cpu_count()
+        if self._modelObject is not None:
+            params = self.getRawParameters()
+        else:
+            params = np.array([p.value for p in self._modelDescr.parameterList()])
+        
+        fits_file = None
+        if isinstance(out, str):
+            fits_file = out
+            hdulist = _create_fits(fits_file, shape, overwrite)
+            out = hdulist[0].data
+        elif out is None:
+            out = np.empty(shape, dtype='float64')
+        elif np.shape(out) != shape:
+            raise ValueError('Output array shape does not match the model image.')
+        
+        tiles = [(y0, min(y0 + tile_size[0], shape[0]), x0, min(x0 + tile_size[1], shape[1]))
+                 for y0 in range(0, shape[0], tile_size[0])
+                 for x0 in range(0, shape[1], tile_size[1])]
+        workers = min(workers, len(tiles))
+        nproc = None if workers == 1 else max(1, cpu_count() // workers)
+        
+        def render_tiles(w):
+            # One model object for each tile shape, the tiles
+            # at the borders of the image can be smaller.
+            model_objects = {}
+            try:
+                for y0, y1, x0, x1 in tiles[w::workers]:
+                    tile_shape = (y1 - y0, x1 - x0)
+                    if tile_shape not in model_objects:
+                        model_object = self._newModelObject(nproc, tile_shape)
+                        model_object.setupModelImage(tile_shape)
+                        model_objects[tile_shape] = model_object
+                    model_object = model_objects[tile_shape]
+                    model_object.setCoordinateOffset(x0, y0)
+                    model_object.createModelImage(params)
+                    out[y0:y1, x0:x1] = model_object.getModelImage(view=True)
+            finally:
+                for model_object in model_objects.values():
+                    model_object.close()
+        
+        try:
+            if workers == 1:
+                render_tiles(0)
+            else:
+                self._parallelMap(render_tiles, range(workers), workers)
+        finally:
+            if fits_file is not None:
+                hdulist.close()
+        if fits_file is not None:
+            return fits_file
+        return out
         
         
     def __del__(self):
+        if self._renderer is not None:
+            self._renderer.close()
+        self._closeBatchRenderers()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        if self._threadPool is not None:
+            self._threadPool.close()
+        self._closeClones()
         if self._modelObject is not None:
             # FIXME: Find a better way to free cython resources.
             self._modelObject.close()
 ################################################################################
+
+
+################################################################################
+class _ModelImageCache(object):
+    '''
+    Least recently used cache of model images, limited by the
+    total size of the images in bytes.
+    '''
+    
+    def __init__(self, max_bytes):
+        self.maxBytes = max_bytes
+        self.nBytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._images = OrderedDict()
+        
+        
+    def get(self, key):
+        image = self._images.pop(key, None)
+        if image is None:
+            self.misses += 1
+            return None
+        # Move to the most recently used end.
+        self._images[key] = image
+        self.hits += 1
+        return image
+    
+    
+    def put(self, key, image):
+        if image.nbytes > self.maxBytes:
+            return
+        if key in self._images:
+            self.nBytes -= self._images.pop(key).nbytes
+        while self.nBytes + image.nbytes > self.maxBytes:
+            _, old_image = self._images.popitem(last=False)
+            self.nBytes -= old_image.nbytes
+        self._images[key] = image
+        self.nBytes += image.nbytes
+        
+        
+    def clear(self):
+        self._images.clear()
+        self.nBytes = 0
+################################################################################
+
+
+################################################################################
+def _component_names(model_descr):
+    '''
+    Names of the functions of the model, prefixed by the name of
+    their function set when the same name is used in other sets.
+    '''
+    functions = [(fs.name, f.name) for fs in model_descr._functionSets for f in fs._functions]
+    func_names = [f for _, f in functions]
+    return [f if func_names.count(f) == 1 else '%s.%s' % (fs, f) for fs, f in functions]
+################################################################################
+
+
+################################################################################
+def _create_fits(filename, shape, overwrite=False):
+    '''
+    Create a FITS file for a ``float64`` image of ``shape``, without
+    allocating it in memory, and open it in update mode, memory-mapped.
+    An existing file is replaced only if ``overwrite`` is ``True``.
+    '''
+    from astropy.io import fits
+    header = fits.PrimaryHDU(data=np.zeros((1, 1), dtype='float64')).header
+    header['NAXIS1'] = shape[1]
+    header['NAXIS2'] = shape[0]
+    if os.path.exists(filename):
+        if not overwrite:
+            raise OSError('File %s already exists. Use overwrite=True to replace it.' % filename)
+        os.remove(filename)
+    header.tofile(filename)
+    data_size = shape[0] * shape[1] * 8
+    # FITS files are made of 2880-byte blocks.
+    data_size = ((data_size + 2879) // 2880) * 2880
+    with open(filename, 'rb+') as f:
+        f.seek(len(header.tostring()) + data_size - 1)
+        f.write(b'\0')
+    return fits.open(filename, mode='update', memmap=True)
+################################################################################
+
+
+################################################################################
+class FitResult(object):
+    '''
+    Results of a fit, detached from the :class:`Imfit` instance
+    used to compute them. Returned by :meth:`Imfit.fit_many`,
+    :meth:`Imfit.fitSequence` and :meth:`Imfit.fit_async`.
+    
+    The attributes have the same meaning as the ones in :class:`Imfit`.
+    '''
+    
+    def __init__(self, imfit):
+        self.modelDescr = imfit.getModelDescription()
+        self.rawParameters = imfit.getRawParameters()
+        self.fitConverged = imfit.fitConverged
+        self.fitError = imfit.fitError
+        self.fitTerminated = imfit.fitTerminated
+        self.fitCancelled = imfit.fitCancelled
+        self.fitBudgetExceeded = imfit.fitBudgetExceeded
+        self.warmStart = False
+        self.nIter = imfit.nIter
+        self.nFev = imfit.nFev
+        self.nPegged = imfit.nPegged
+        self.nValidPixels = imfit.nValidPixels
+        self.fitStatistic = imfit.fitStatistic
+        self.reducedFitStatistic = imfit.reducedFitStatistic
+        self.AIC = imfit.AIC
+        self.BIC = imfit.BIC
+################################################################################
+
+
+################################################################################
+class FitStats(object):
+    '''
+    Performance counters of a fit, see :attr:`Imfit.stats`.
+    
+    Times are in seconds. In the parallel modes, ``modelTime`` and
+    ``convolutionTime`` are summed over all threads, and for
+    ``'LM-multistart'`` so is ``solverTime``.
+    
+    Attributes
+    ----------
+    nModelImages : int
+        Number of model images computed by the solver.
+        
+    nFev : int
+        Number of model evaluations requested by the solver.
+        
+    modelTime : float
+        Time spent computing the model images, not counting the PSF convolution.
+        
+    convolutionTime : float
+        Time spent convolving the model images with the PSF.
+        
+    solverTime : float
+        Wall time of the solver, including the model evaluations.
+        
+    loadTime : float
+        Time spent preparing and loading the data into the model objects.
+    '''
+    
+    def __init__(self):
+        self.nModelImages = 0
+        self.nFev = 0
+        self.modelTime = 0.0
+        self.convolutionTime = 0.0
+        self.solverTime = 0.0
+        self.loadTime = 0.0
+        
+        
+    def _add(self, model_object):
+        stats = model_object.getStats()
+        self.nModelImages += stats['nModelImages']
+        self.nFev += stats['nFev']
+        self.modelTime += stats['modelTime']
+        self.convolutionTime += stats['convolutionTime']
+        self.solverTime += stats['solverTime']
+        
+        
+    @property
+    def solverOverhead(self):
+        '''
+        Time spent by the solver outside of the model image computation,
+        including the computation of the deviates or fit statistic.
+        '''
+        return max(0.0, self.solverTime - self.modelTime - self.convolutionTime)
+    
+    
+    def __str__(self):
+        return 'model images: %d, evaluations: %d, model: %.3fs, convolution: %.3fs, ' \
+               'solver overhead: %.3fs, loading: %.3fs' % \
+               (self.nModelImages, self.nFev, self.modelTime, self.convolutionTime,
+                self.solverOverhead, self.loadTime)
+################################################################################
+
+
+################################################################################
+# Worker process state for Imfit.fit_many(), set by _fit_many_init().
+_worker_imfit = None
+
+
+def _fit_many_init(model_descr, psf, nproc, chunk_size, subsampling, incremental):
+    global _worker_imfit
+    _worker_imfit = Imfit(model_descr, psf=psf, quiet=True, nproc=nproc,
+                          chunk_size=chunk_size, subsampling=subsampling, persistent=True,
+                          incremental=incremental)
+
+
+def _fit_many_task(task):
+    i, image, error, mask, mode, kwargs = task
+    _worker_imfit.fit(image, error, mask, mode=mode, **kwargs)
+    return i, FitResult(_worker_imfit)
+
+
+def _fit_many_tasks(images, errors, masks, mode, kwargs):
+    for i, image in enumerate(images):
+        error = errors[i] if errors is not None else None
+        mask = masks[i] if masks is not None else None
+        yield i, image, error, mask, mode, kwargs
+
+
+def _fit_many_iter(tasks, workers, initargs, ordered):
+    from multiprocessing import Pool
+    pool = Pool(workers, _fit_many_init, initargs)
+    try:
+        if ordered:
+            results = pool.imap(_fit_many_task, tasks)
+        else:
+            results = pool.imap_unordered(_fit_many_task, tasks)
+        for r in results:
+            yield r
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+################################################################################
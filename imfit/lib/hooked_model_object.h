@@ -0,0 +1,546 @@
+/*
+ * hooked_model_object.h
+ *
+ * Subclass of Imfit's ModelObject used by the Python wrapper. It calls
+ * a hook function after each evaluation of the fit statistic made by the
+ * solvers, which lets the wrapper watch the progress of a fit and stop it.
+ *
+ * The solvers have no way of being interrupted, so after a stop is
+ * requested the fit statistic (or the deviates, for L-M) is reported as
+ * zero without evaluating the model, which makes every solver converge
+ * on its next check. The wrapper keeps track of the best parameters.
+ *
+ * It also counts the model images computed, and measures the time spent
+ * computing them, separating the PSF convolution.
+ *
+ * Tied parameters are flagged as fixed for the solvers, and their values
+ * are computed from the parameters they are tied to before every model
+ * image is computed.
+ *
+ * CreateComponentImages() computes the image of each function separately,
+ * following the same steps as ModelObject::CreateModelImage(). It uses the
+ * protected members of ModelObject, and must be kept in sync with it.
+ *
+ * In incremental mode, the (unconvolved) image of each function is kept,
+ * and only the functions whose parameters changed since the last model
+ * image are computed again. The model image is the sum of the kept images,
+ * added in the same order as in ModelObject::CreateModelImage().
+ *
+ * Functions whose parameters are all fixed, center included, are computed
+ * and convolved once by CreateBackground(), and the result is added to every
+ * model image computed with the same values for them. Other values (for
+ * instance, when a fixed parameter is scanned) compute the full model.
+ *
+ * ModelObject::SetMaxThreads() calls omp_set_num_threads(), which only
+ * affects the calling thread, while the model objects are often set up in
+ * one thread and evaluated in others. The thread count is kept here, and
+ * applied to the evaluating thread only while the model is computed, so
+ * that the other model objects used by that thread are not affected.
+ */
+
+#ifndef _HOOKED_MODEL_OBJECT_H_
+#define _HOOKED_MODEL_OBJECT_H_
+
+#include <time.h>
+#include <vector>
+#ifdef _OPENMP
+#include <omp.h>
+#endif
+
+#include "imfit/model_object.h"
+
+
+// Called with the parameter vector and the fit statistic of each evaluation.
+// A nonzero return value requests the fit to stop.
+typedef int (*evaluation_hook)( void *owner, double *params, double fitStatistic );
+
+
+static inline double MonotonicTime( )
+{
+  struct timespec  t;
+
+  clock_gettime(CLOCK_MONOTONIC, &t);
+  return t.tv_sec + t.tv_nsec*1e-9;
+}
+
+
+// Sets the OpenMP thread count of the calling thread while in scope, if
+// nThreads is positive, and restores the previous one afterwards.
+class ThreadCountScope
+{
+  public:
+    ThreadCountScope( int nThreads )
+    {
+#ifdef _OPENMP
+      previousThreads = omp_get_max_threads();
+      if (nThreads > 0)
+        omp_set_num_threads(nThreads);
+#endif
+    }
+
+    ~ThreadCountScope( )
+    {
+#ifdef _OPENMP
+      omp_set_num_threads(previousThreads);
+#endif
+    }
+
+  private:
+    int  previousThreads;
+};
+
+
+class HookedModelObject : public ModelObject
+{
+  public:
+    HookedModelObject( ) : ModelObject( )
+    {
+      hook = NULL;
+      hookOwner = NULL;
+      nDeviates = 0;
+      stopRequested = false;
+      computingFitStatistic = false;
+      incremental = false;
+      componentColumns = 0;
+      backgroundValid = false;
+      backgroundColumns = 0;
+      nThreads = 0;
+      ResetStats();
+    }
+
+    // Hides ModelObject::SetMaxThreads(), leaving the thread count of
+    // the calling thread unchanged.
+    void SetMaxThreads( int maxThreadNumber )
+    {
+      ThreadCountScope  threads(0);
+
+      ModelObject::SetMaxThreads(maxThreadNumber);
+      nThreads = maxThreadNumber;
+    }
+
+    void SetEvaluationHook( evaluation_hook newHook, void *owner )
+    {
+      hook = newHook;
+      hookOwner = owner;
+    }
+
+    void SetNDeviates( long nDeviatesValues ) { nDeviates = nDeviatesValues; }
+
+    void ClearStop( ) { stopRequested = false; }
+
+    bool StopRequested( ) { return stopRequested; }
+
+    void ResetStats( )
+    {
+      nModelImages = 0;
+      modelTime = 0.0;
+      convolutionTime = 0.0;
+    }
+
+    long GetNModelImages( ) { return nModelImages; }
+
+    double GetModelTime( ) { return modelTime; }
+
+    double GetConvolutionTime( ) { return convolutionTime; }
+
+    // Parameter tiedIndices[i] is set to scales[i]*params[refIndices[i]] + offsets[i].
+    // The referenced parameters must not be tied themselves.
+    void SetTies( int nParamsTot, int nTies, int *tiedIndices, int *refIndices,
+                  double *scales, double *offsets )
+    {
+      tiedIndex.assign(tiedIndices, tiedIndices + nTies);
+      refIndex.assign(refIndices, refIndices + nTies);
+      tieScale.assign(scales, scales + nTies);
+      tieOffset.assign(offsets, offsets + nTies);
+      tiedParams.resize(nParamsTot);
+    }
+
+    void ApplyTies( double params[] )
+    {
+      for (size_t i = 0; i < tiedIndex.size(); i++)
+        params[tiedIndex[i]] = tieScale[i]*params[refIndex[i]] + tieOffset[i];
+    }
+
+    int GetNComponents( ) { return nFunctions; }
+
+    // Keeps nFunctions images of the size of the model image.
+    void SetIncremental( bool incrementalFlag )
+    {
+      incremental = incrementalFlag;
+      std::vector<double>().swap(componentCache);
+      std::vector< std::vector<double> >().swap(componentParams);
+    }
+
+    bool GetIncremental( ) { return incremental; }
+
+    // fixedFlags holds a nonzero value for each parameter which is constant
+    // during the fits, and selects the functions computed by CreateBackground().
+    void SetFixedParameters( int *fixedFlags )
+    {
+      FunctionIndices();
+      fixedFunction.assign(nFunctions, false);
+      for (int n = 0; n < nFunctions; n++) {
+        bool  fixed = fixedFlags[centerIndex[n]] && fixedFlags[centerIndex[n] + 1];
+        for (int p = 0; p < paramSizes[n]; p++)
+          fixed = fixed && fixedFlags[paramIndex[n] + p];
+        fixedFunction[n] = fixed;
+      }
+      ClearBackground();
+    }
+
+    int GetNFixedComponents( )
+    {
+      int  nFixed = 0;
+      for (size_t n = 0; n < fixedFunction.size(); n++)
+        nFixed += fixedFunction[n];
+      return nFixed;
+    }
+
+    bool HasBackground( ) { return backgroundValid; }
+
+    // Compute the convolved image of the fixed functions, with the values
+    // in params. Must be called after FinalSetupForFitting().
+    void CreateBackground( double params[] )
+    {
+      double  x, y, newVal;
+      long  i, j, k;
+      int  n, c;
+      std::vector<int>  fixed;
+      ThreadCountScope  threads(nThreads);
+
+      ClearBackground();
+      for (n = 0; n < (int)fixedFunction.size(); n++)
+        if (fixedFunction[n])
+          fixed.push_back(n);
+      if (fixed.empty())
+        return;
+      params = TiedParams(params);
+      backgroundParams.resize(nFunctions);
+      for (c = 0; c < (int)fixed.size(); c++) {
+        n = fixed[c];
+        functionObjects[n]->Setup(params, paramIndex[n], params[centerIndex[n]],
+                                  params[centerIndex[n] + 1]);
+        KeepParams(backgroundParams[n], params, n);
+      }
+      backgroundVector.resize(nModelVals);
+      int  nFixed = fixed.size();
+#ifdef _OPENMP
+#pragma omp parallel private(i, j, k, n, c, x, y, newVal)
+#endif
+      {
+#ifdef _OPENMP
+#pragma omp for schedule (static, ompChunkSize)
+#endif
+      for (i = 0; i < nModelVals; i++) {
+        j = i / nModelColumns;
+        k = i - j*nModelColumns;
+        y = (double)(j - nPSFRows + 1);
+        x = (double)(k - nPSFColumns + 1);
+        newVal = 0.0;
+        for (c = 0; c < nFixed; c++)
+          newVal += functionObjects[fixed[c]]->GetValue(x, y);
+        backgroundVector[i] = newVal;
+      }
+      }
+      if (doConvolution)
+        psfConvolver->ConvolveImage(&backgroundVector[0]);
+      backgroundColumns = nModelColumns;
+      backgroundValid = true;
+    }
+
+    void ClearBackground( )
+    {
+      backgroundValid = false;
+      std::vector<double>().swap(backgroundVector);
+      std::vector< std::vector<double> >().swap(backgroundParams);
+    }
+
+    // Write the image of each function to consecutive planes of output, which
+    // must hold nFunctions*nDataVals values. All the functions are evaluated
+    // in a single pass over the pixels.
+    void CreateComponentImages( double params[], double *output, bool convolve )
+    {
+      double  x0 = 0.0, y0 = 0.0, x, y;
+      int  offset = 0;
+      long  nDataVals = (long)nDataColumns*nDataRows;
+      long  i, j, k;
+      int  n;
+      double  *components;
+      bool  padded = doConvolution;
+      ThreadCountScope  threads(nThreads);
+
+      params = TiedParams(params);
+      for (n = 0; n < nFunctions; n++) {
+        if (fsetStartFlags[n] == true) {
+          x0 = params[offset];
+          y0 = params[offset + 1];
+          offset += 2;
+        }
+        functionObjects[n]->Setup(params, offset, x0, y0);
+        offset += paramSizes[n];
+      }
+
+      // With a PSF the model is computed over a larger image, like in
+      // CreateModelImage(), and the data region is copied afterwards.
+      if (padded) {
+        componentBuffer.resize(nFunctions*nModelVals);
+        components = &componentBuffer[0];
+      }
+      else
+        components = output;
+
+#ifdef _OPENMP
+#pragma omp parallel private(i, j, k, n, x, y)
+#endif
+      {
+#ifdef _OPENMP
+#pragma omp for schedule (static, ompChunkSize)
+#endif
+      for (i = 0; i < nModelVals; i++) {
+        j = i / nModelColumns;
+        k = i - j*nModelColumns;
+        y = (double)(j - nPSFRows + 1);
+        x = (double)(k - nPSFColumns + 1);
+        for (n = 0; n < nFunctions; n++)
+          components[n*nModelVals + i] = functionObjects[n]->GetValue(x, y);
+      }
+      }
+
+      if (! padded)
+        return;
+      for (n = 0; n < nFunctions; n++) {
+        if (convolve)
+          psfConvolver->ConvolveImage(components + n*nModelVals);
+        for (j = 0; j < nDataRows; j++)
+          for (k = 0; k < nDataColumns; k++)
+            output[n*nDataVals + j*nDataColumns + k] =
+                components[n*nModelVals + (j + nPSFRows)*nModelColumns + k + nPSFColumns];
+      }
+    }
+
+    // The convolution is done here instead of in ModelObject, to time it
+    // separately. Pixel coordinates do not depend on doConvolution.
+    virtual void CreateModelImage( double params[] )
+    {
+      double  t0, t1, t2;
+      bool  convolve = doConvolution;
+      ThreadCountScope  threads(nThreads);
+
+      params = TiedParams(params);
+      t0 = MonotonicTime();
+      bool  useBackground = BackgroundMatches(params);
+      if (incremental || useBackground)
+        CreateModelImagePartial(params, useBackground);
+      else {
+        doConvolution = false;
+        ModelObject::CreateModelImage(params);
+        doConvolution = convolve;
+      }
+      t1 = MonotonicTime();
+      if (convolve)
+        psfConvolver->ConvolveImage(modelVector);
+      t2 = MonotonicTime();
+      // The background is already convolved.
+      if (useBackground)
+        for (long i = 0; i < nModelVals; i++)
+          modelVector[i] += backgroundVector[i];
+      nModelImages++;
+      modelTime += t1 - t0 + MonotonicTime() - t2;
+      convolutionTime += t2 - t1;
+    }
+
+    // Used by the L-M solver.
+    virtual void ComputeDeviates( double yResults[], double params[] )
+    {
+      double  chiSquared = 0.0;
+      ThreadCountScope  threads(nThreads);
+
+      if (stopRequested) {
+        for (long z = 0; z < nDeviates; z++)
+          yResults[z] = 0.0;
+        return;
+      }
+      ModelObject::ComputeDeviates(yResults, params);
+      if ((hook != NULL) && (! computingFitStatistic)) {
+        for (long z = 0; z < nDeviates; z++)
+          chiSquared += yResults[z]*yResults[z];
+        if (hook(hookOwner, params, chiSquared) != 0)
+          stopRequested = true;
+      }
+    }
+
+    // Used by the DE and N-M solvers.
+    virtual double GetFitStatistic( double params[] )
+    {
+      double  fitStatistic;
+      ThreadCountScope  threads(nThreads);
+
+      if (stopRequested)
+        return 0.0;
+      computingFitStatistic = true;
+      fitStatistic = ModelObject::GetFitStatistic(params);
+      computingFitStatistic = false;
+      if ((hook != NULL) && (hook(hookOwner, params, fitStatistic) != 0))
+        stopRequested = true;
+      return fitStatistic;
+    }
+
+  private:
+    // Index of the center and of the first parameter of each function.
+    void FunctionIndices( )
+    {
+      int  offset = 0, centerOffset = 0;
+
+      if ((int)centerIndex.size() == nFunctions)
+        return;
+      centerIndex.resize(nFunctions);
+      paramIndex.resize(nFunctions);
+      for (int n = 0; n < nFunctions; n++) {
+        if (fsetStartFlags[n] == true) {
+          centerOffset = offset;
+          offset += 2;
+        }
+        centerIndex[n] = centerOffset;
+        paramIndex[n] = offset;
+        offset += paramSizes[n];
+      }
+    }
+
+    void KeepParams( std::vector<double> &kept, double params[], int n )
+    {
+      kept.resize(paramSizes[n] + 2);
+      kept[0] = params[centerIndex[n]];
+      kept[1] = params[centerIndex[n] + 1];
+      for (int p = 0; p < paramSizes[n]; p++)
+        kept[p + 2] = params[paramIndex[n] + p];
+    }
+
+    bool SameParams( std::vector<double> &kept, double params[], int n )
+    {
+      if ((int)kept.size() != paramSizes[n] + 2)
+        return false;
+      if ((kept[0] != params[centerIndex[n]]) || (kept[1] != params[centerIndex[n] + 1]))
+        return false;
+      for (int p = 0; p < paramSizes[n]; p++)
+        if (kept[p + 2] != params[paramIndex[n] + p])
+          return false;
+      return true;
+    }
+
+    bool BackgroundMatches( double params[] )
+    {
+      if ((! backgroundValid) || (backgroundColumns != nModelColumns) ||
+          ((long)backgroundVector.size() != nModelVals))
+        return false;
+      for (int n = 0; n < nFunctions; n++)
+        if (fixedFunction[n] && (! SameParams(backgroundParams[n], params, n)))
+          return false;
+      return true;
+    }
+
+    // Sum the functions, leaving out the ones in the background if skipFixed
+    // is true. Not convolved. In incremental mode, compute again only the
+    // functions whose parameters differ from the ones of the kept images.
+    void CreateModelImagePartial( double params[], bool skipFixed )
+    {
+      double  x, y, newVal;
+      long  i, j, k;
+      int  n, c;
+      std::vector<int>  active, changed;
+      double  *components = NULL;
+
+      FunctionIndices();
+      if (incremental) {
+        if (((long)componentCache.size() != nFunctions*nModelVals) ||
+            (componentColumns != nModelColumns)) {
+          componentCache.assign(nFunctions*nModelVals, 0.0);
+          componentParams.assign(nFunctions, std::vector<double>());
+          componentColumns = nModelColumns;
+        }
+        components = &componentCache[0];
+      }
+      for (n = 0; n < nFunctions; n++) {
+        if (skipFixed && fixedFunction[n])
+          continue;
+        active.push_back(n);
+        if (incremental && SameParams(componentParams[n], params, n))
+          continue;
+        functionObjects[n]->Setup(params, paramIndex[n], params[centerIndex[n]],
+                                  params[centerIndex[n] + 1]);
+        changed.push_back(n);
+        if (incremental)
+          KeepParams(componentParams[n], params, n);
+      }
+
+      int  nActive = active.size();
+      int  nChanged = changed.size();
+#ifdef _OPENMP
+#pragma omp parallel private(i, j, k, n, c, x, y, newVal)
+#endif
+      {
+#ifdef _OPENMP
+#pragma omp for schedule (static, ompChunkSize)
+#endif
+      for (i = 0; i < nModelVals; i++) {
+        j = i / nModelColumns;
+        k = i - j*nModelColumns;
+        y = (double)(j - nPSFRows + 1);
+        x = (double)(k - nPSFColumns + 1);
+        newVal = 0.0;
+        if (incremental) {
+          for (c = 0; c < nChanged; c++) {
+            n = changed[c];
+            components[n*nModelVals + i] = functionObjects[n]->GetValue(x, y);
+          }
+          for (c = 0; c < nActive; c++)
+            newVal += components[active[c]*nModelVals + i];
+        }
+        else {
+          for (c = 0; c < nActive; c++)
+            newVal += functionObjects[active[c]]->GetValue(x, y);
+        }
+        modelVector[i] = newVal;
+      }
+      }
+      modelImageComputed = true;
+    }
+
+    // The solvers own params, the tied values are computed in a copy.
+    double *TiedParams( double params[] )
+    {
+      if (tiedIndex.empty())
+        return params;
+      tiedParams.assign(params, params + tiedParams.size());
+      ApplyTies(&tiedParams[0]);
+      return &tiedParams[0];
+    }
+
+    evaluation_hook  hook;
+    void  *hookOwner;
+    long  nDeviates;
+    volatile bool  stopRequested;
+    bool  computingFitStatistic;
+    long  nModelImages;
+    double  modelTime;
+    double  convolutionTime;
+    std::vector<int>  tiedIndex;
+    std::vector<int>  refIndex;
+    std::vector<double>  tieScale;
+    std::vector<double>  tieOffset;
+    std::vector<double>  tiedParams;
+    std::vector<double>  componentBuffer;
+    std::vector<int>  centerIndex;
+    std::vector<int>  paramIndex;
+    bool  incremental;
+    std::vector<double>  componentCache;
+    std::vector< std::vector<double> >  componentParams;
+    int  componentColumns;
+    std::vector<bool>  fixedFunction;
+    bool  backgroundValid;
+    std::vector<double>  backgroundVector;
+    std::vector< std::vector<double> >  backgroundParams;
+    int  backgroundColumns;
+    int  nThreads;
+};
+
+#endif   // _HOOKED_MODEL_OBJECT_H_
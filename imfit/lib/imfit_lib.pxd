@@ -15,7 +15,7 @@ cdef extern from 'imfit/param_struct.h':
                             # being fitted)
 
 
-cdef extern from 'imfit/model_object.h':
+cdef extern from 'imfit/model_object.h' nogil:
     cdef cppclass ModelObject:
         # WARNING: calling SetupModelImage and AddImageDataVector in the
         # same ModelObject instance (or any of them more than once) will
@@ -32,6 +32,7 @@ cdef extern from 'imfit/model_object.h':
         bool UsingCashStatistic()
         int AddMaskVector(int nDataValues, int nImageColumns, int nImageRows,
                           double *pixelVector, int inputType)
+        void ApplyMask()
         void AddPSFVector(int nPixels_psf, int nColumns_psf, int nRows_psf,
                           double *psfPixels)
         int FinalSetupForFitting()
@@ -42,11 +43,37 @@ cdef extern from 'imfit/model_object.h':
         void CreateModelImage(double params[])
         double *GetModelImageVector()
         double GetFitStatistic(double params[])
+        void ComputeDeviates(double yResults[], double params[])
         void SetDebugLevel(int debuggingLevel)
         void SetVerboseLevel(int level)
         void SetOMPChunkSize(int chunkSize)
 
 
+cdef extern from 'hooked_model_object.h' nogil:
+    ctypedef int (*evaluation_hook)(void *owner, double *params, double fitStatistic)
+
+    cdef cppclass HookedModelObject(ModelObject):
+        void SetEvaluationHook(evaluation_hook hook, void *owner)
+        void SetNDeviates(long nDeviatesValues)
+        void ClearStop()
+        bool StopRequested()
+        void ResetStats()
+        long GetNModelImages()
+        double GetModelTime()
+        double GetConvolutionTime()
+        void SetTies(int nParamsTot, int nTies, int *tiedIndices, int *refIndices,
+                     double *scales, double *offsets)
+        void ApplyTies(double params[])
+        int GetNComponents()
+        void SetIncremental(bool incrementalFlag)
+        bool GetIncremental()
+        void SetFixedParameters(int *fixedFlags)
+        int GetNFixedComponents()
+        bool HasBackground()
+        void CreateBackground(double params[])
+        void CreateComponentImages(double params[], double *output, bool convolve)
+
+
 cdef extern from 'imfit/add_functions.h':
     int AddFunctions(ModelObject *theModel, vector[string] &functionNameList,
                      vector[int] &functionSetIndices, bool subamplingFlag, bool verbose)
@@ -84,18 +111,18 @@ cdef extern from 'imfit/mpfit_cpp.h':
         char version[20]    # MPFIT version string
 
 
-cdef extern from 'imfit/levmar_fit.h':
+cdef extern from 'imfit/levmar_fit.h' nogil:
     int LevMarFit(int nParamsTot, int nFreeParams, int nDataVals, double *paramVector, 
                   mp_par *parameterLimits, ModelObject *theModel, double ftol, 
                   bool paramLimitsExist, mp_result &resultOut, int verbose)
 
 
-cdef extern from 'imfit/diff_evoln_fit.h':
+cdef extern from 'imfit/diff_evoln_fit.h' nogil:
     int DiffEvolnFit(int nParamsTot, double *initialParams, mp_par *parameterLimits,
                      ModelObject *theModel, double ftol, int verbose)
 
 
-cdef extern from 'imfit/nmsimplex_fit.h':
+cdef extern from 'imfit/nmsimplex_fit.h' nogil:
     int NMSimplexFit(int nParamsTot, double *paramVector, mp_par *parameterLimits, 
                      ModelObject *theModel, double ftol, int verbose )
 
@@ -104,7 +131,7 @@ cdef extern from 'imfit/statistics.h':
     double AIC_corrected(double logLikelihood, int nParams, long nData, int chiSquareUsed)
     double BIC(double logLikelihood, int nParams, long nData, int chiSquareUsed)
 
-cdef extern from 'imfit/convolver.h':
+cdef extern from 'imfit/convolver.h' nogil:
     cdef cppclass Convolver:
         void SetupPSF(double *psfPixels_input, int nColumns, int nRows)
         void SetMaxThreads(int maximumThreadNumber)
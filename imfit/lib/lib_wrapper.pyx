@@ -4,7 +4,7 @@ Created on Sep 15, 2013
 @author: andre
 '''
 
-from .imfit_lib cimport ModelObject, mp_par, mp_result
+from .imfit_lib cimport ModelObject, HookedModelObject, mp_par, mp_result
 from .imfit_lib cimport AddFunctions, LevMarFit, DiffEvolnFit, NMSimplexFit
 from .imfit_lib cimport GetFunctionParameters, GetFunctionNames as GetFunctionNames_lib 
 from .imfit_lib cimport AIC_corrected, BIC
@@ -18,6 +18,7 @@ cimport numpy as np
 import numpy as np
 from os import path
 from copy import deepcopy
+import weakref
 
 import cython
 from libcpp.string cimport string
@@ -25,8 +26,12 @@ from libcpp.vector cimport vector
 from libcpp cimport bool
 from libc.stdlib cimport calloc, free
 from libc.string cimport memcpy
+from libc.math cimport INFINITY
+from posix.time cimport clock_gettime, timespec, CLOCK_MONOTONIC
 
 
+np.import_array()
+
 __all__ = ['function_types', 'function_description', 'convolve_image', 'ModelObjectWrapper']
 
 ################################################################################
@@ -123,9 +128,11 @@ def convolve_image(np.ndarray[np.double_t, ndim=2, mode='c'] image not None,
         
     convolver.SetupImage(image.shape[1], image.shape[0])
     cdef int debug_level = 1 if verbose else -1
+    # The FFTW planner is not thread safe, keep the GIL while planning.
     convolver.DoFullSetup(debug_level, do_fftw_measure)
     cdef double *image_data = alloc_copy_from_ndarray(image)
-    convolver.ConvolveImage(image_data)
+    with nogil:
+        convolver.ConvolveImage(image_data)
     
     shape = (image.shape[0], image.shape[1])
     cdef np.ndarray[np.double_t, ndim=2, mode='c'] convolved_image
@@ -153,51 +160,144 @@ cdef double *alloc_copy_from_ndarray(np.ndarray[np.double_t, ndim=2, mode='c'] o
 
 ################################################################################
 
+cdef enum:
+    STOP_NONE = 0
+    STOP_CANCELLED = 1
+    STOP_MAX_FEV = 2
+    STOP_MAX_TIME = 3
+
+
+cdef struct EvaluationState:
+    int nParams
+    long nEvaluations
+    double bestFitStatistic
+    double *bestParams
+    bint cancelRequested
+    int stopReason
+    long maxEvaluations
+    double deadline
+    long callbackInterval
+    void *wrapper
+
+
+cdef inline double _wall_time() nogil:
+    cdef timespec t
+    clock_gettime(CLOCK_MONOTONIC, &t)
+    return t.tv_sec + t.tv_nsec * 1e-9
+
+
+cdef int _evaluation_hook(void *owner, double *params, double fit_statistic) noexcept nogil:
+    '''
+    Called by HookedModelObject after every evaluation during a fit.
+    Keeps the best parameters found, and returns nonzero to stop the fit.
+    The GIL is only taken when the progress callback is due.
+    '''
+    cdef EvaluationState *state = <EvaluationState *> owner
+    state.nEvaluations += 1
+    if fit_statistic < state.bestFitStatistic:
+        state.bestFitStatistic = fit_statistic
+        memcpy(state.bestParams, params, state.nParams * sizeof(double))
+    if state.callbackInterval > 0 and state.nEvaluations % state.callbackInterval == 0:
+        if _progress_callback(state, params, fit_statistic) != 0:
+            state.cancelRequested = True
+    if state.cancelRequested:
+        state.stopReason = STOP_CANCELLED
+        return 1
+    if state.maxEvaluations > 0 and state.nEvaluations >= state.maxEvaluations:
+        state.stopReason = STOP_MAX_FEV
+        return 1
+    if state.deadline > 0 and _wall_time() >= state.deadline:
+        state.stopReason = STOP_MAX_TIME
+        return 1
+    return 0
+
+################################################################################
+
 cdef class ModelObjectWrapper(object):
+    '''
+    Wrapper around the ModelObject class from Imfit.
+    
+    The solvers and the model image computation run without holding
+    the GIL, so that separate instances can be used concurrently from
+    different threads. The setup methods (loading data, setting the PSF)
+    keep the GIL, as the FFTW planner is not thread safe. A single
+    instance must not be used by more than one thread at a time.
+    '''
 
-    cdef ModelObject *_model 
+    cdef HookedModelObject *_model 
     cdef mp_par *_paramInfo
     cdef double *_paramVect
+    cdef double *_paramOffsets
     cdef bool _paramLimitsExist
     cdef int _nParams
     cdef int _nFreeParams
     cdef object _modelDescr
     cdef object _parameterList
+    cdef object _ties
     cdef int _nPixels, _nRows, _nCols
     cdef mp_result _fitResult
     cdef int _fitStatus
+    cdef EvaluationState _evalState
     
     cdef double *_imageData
     cdef double *_errorData
     cdef double *_maskData
     cdef double *_psfData
+    cdef bool _ownsData
+    cdef object _imageRef
+    cdef int _errorType
+    cdef int _maskFormat
     cdef bool _inputDataLoaded
+    cdef bool _finalSetupDone
     cdef bool _fitted
     cdef object _fitMode
     cdef bool _freed
+    cdef bool _busy
+    cdef bool _modelImageStale
+    cdef object _views
+    cdef object _callback
+    cdef object _callbackError
+    cdef double _solverTime
+    cdef long _nEvaluationsTotal
     
 
     def __init__(self, object model_descr, int debug_level=0, int verbose_level=-1, bool subsampling=True):
         self._paramLimitsExist = False
         self._paramInfo = NULL
         self._paramVect = NULL
+        self._paramOffsets = NULL
         self._model = NULL
+        self._evalState.bestParams = NULL
+        self._evalState.cancelRequested = False
+        self._evalState.stopReason = STOP_NONE
+        self._evalState.callbackInterval = 0
+        self._evalState.wrapper = <void *> self
+        self._callback = None
+        self._callbackError = None
+        self._solverTime = 0.0
+        self._nEvaluationsTotal = 0
 
         self._imageData = NULL
         self._errorData = NULL
         self._maskData = NULL
         self._psfData = NULL
+        self._ownsData = True
+        self._imageRef = None
         self._inputDataLoaded = False
+        self._finalSetupDone = False
         self._fitted = False
         self._fitMode = None
         self._freed = False
+        self._busy = False
+        self._modelImageStale = False
+        self._views = []
         self._fitStatus = 0
         
         if not isinstance(model_descr, ModelDescription):
             raise ValueError('model_descr must be a ModelDescription object.')
         self._modelDescr = model_descr
 
-        self._model = new ModelObject()
+        self._model = new HookedModelObject()
         self._model.SetDebugLevel(debug_level)
         self._model.SetVerboseLevel(verbose_level)
         if self._model == NULL:
@@ -207,11 +307,37 @@ cdef class ModelObjectWrapper(object):
         
         
     def setMaxThreads(self, int nproc):
-        self._model.SetMaxThreads(nproc)
+        self._acquire()
+        try:
+            self._model.SetMaxThreads(nproc)
+        finally:
+            self._release()
         
         
     def setChunkSize(self, int chunk_size):
-        self._model.SetOMPChunkSize(chunk_size)
+        self._acquire()
+        try:
+            self._model.SetOMPChunkSize(chunk_size)
+        finally:
+            self._release()
+        
+        
+    def setIncremental(self, bool incremental):
+        '''
+        Keep the image of each function, and compute again only the
+        functions whose parameters changed when computing a new model
+        image. Uses one extra image per function.
+        '''
+        self._acquire()
+        try:
+            self._model.SetIncremental(incremental)
+        finally:
+            self._release()
+        
+        
+    @property
+    def incremental(self):
+        return self._model.GetIncremental()
         
         
     def _paramSetup(self, object model_descr):
@@ -226,10 +352,20 @@ cdef class ModelObjectWrapper(object):
         self._paramVect = <double *> calloc(self._nParams, sizeof(double))
         if self._paramVect == NULL:
             raise MemoryError('Could not allocate parameter initial values.')
+        self._paramOffsets = <double *> calloc(self._nParams, sizeof(double))
+        if self._paramOffsets == NULL:
+            raise MemoryError('Could not allocate parameter offsets.')
+        self._evalState.nParams = self._nParams
+        self._evalState.bestParams = <double *> calloc(self._nParams, sizeof(double))
+        if self._evalState.bestParams == NULL:
+            raise MemoryError('Could not allocate best parameter values.')
     
         # Fill parameter info and initial value.
+        self._ties = self._resolveTies(self._parameterList)
+        tied = [t[0] for t in self._ties]
         for i, param in enumerate(self._parameterList):
-            if param.fixed:
+            if param.fixed or i in tied:
+                # Tied parameters are computed by the model object.
                 self._paramInfo[i].fixed = True
                 self._nFreeParams -= 1
             elif param.limits is not None:
@@ -239,8 +375,137 @@ cdef class ModelObjectWrapper(object):
                 self._paramInfo[i].limits[1] = param.limits[1]
                 self._paramLimitsExist = True
             self._paramVect[i] = param.value
+        self._updateTies()
+        self._setFixedParameters()
+
+
+    @staticmethod
+    def _resolveTies(parameter_list):
+        '''
+        List of ``(index, ref_index, scale, offset)`` of the tied parameters,
+        following chains of ties up to a parameter which is not tied.
+        '''
+        index = dict((id(p), i) for i, p in enumerate(parameter_list))
+        ties = []
+        for i, param in enumerate(parameter_list):
+            scale, offset = 1.0, 0.0
+            ref = param
+            visited = set([i])
+            while ref.tied is not None:
+                ref, s, o = ref.tied
+                if id(ref) not in index:
+                    raise ValueError('Parameter %s is tied to a parameter not in the model.' % param.name)
+                if index[id(ref)] in visited:
+                    raise ValueError('Circular tie in parameter %s.' % param.name)
+                visited.add(index[id(ref)])
+                scale, offset = scale * s, scale * o + offset
+            if ref is not param:
+                ties.append((i, index[id(ref)], scale, offset))
+        return ties
+    
+    
+    cdef _updateTies(self):
+        # The offsets of the tied values change with the coordinate offsets.
+        cdef vector[int] tied_indices, ref_indices
+        cdef vector[double] scales, offsets
+        cdef int i, ref
+        if len(self._ties) == 0:
+            return
+        for i, ref, scale, offset in self._ties:
+            tied_indices.push_back(i)
+            ref_indices.push_back(ref)
+            scales.push_back(scale)
+            offsets.push_back(scale * self._paramOffsets[ref] + offset - self._paramOffsets[i])
+        self._model.SetTies(self._nParams, len(self._ties), &tied_indices[0], &ref_indices[0],
+                            &scales[0], &offsets[0])
+        self._model.ApplyTies(self._paramVect)
+
+
+    cdef _setFixedParameters(self):
+        # Parameters which do not change during the fits. The values tied
+        # to fixed parameters are constant too.
+        cdef vector[int] fixed_flags
+        cdef int i
+        for param in self._parameterList:
+            fixed_flags.push_back(param.fixed)
+        for i, ref, _, _ in self._ties:
+            fixed_flags[i] = self._parameterList[ref].fixed
+        self._model.SetFixedParameters(&fixed_flags[0])
+        
+        
+    def _createBackground(self):
+        # Functions with all parameters fixed are computed only once.
+        if self._model.GetNFixedComponents() > 0:
+            with nogil:
+                self._model.CreateBackground(self._paramVect)
+        
+        
+    @property
+    def nFixedComponents(self):
+        '''
+        Number of functions with all parameters fixed, computed only once
+        and added to the model images during the fits.
+        '''
+        return self._model.GetNFixedComponents()
+        
+        
+    def resetParameters(self):
+        '''
+        Restore the parameter values from the template model description,
+        discarding the results of a previous fit.
+        '''
+        self._acquire()
+        try:
+            self._resetParameters()
+        finally:
+            self._release()
+
+
+    def _resetParameters(self):
+        for i, param in enumerate(self._parameterList):
+            self._paramVect[i] = param.value - self._paramOffsets[i]
+        self._model.ApplyTies(self._paramVect)
+        self._fitted = False
+        self._fitMode = None
+        self._fitStatus = 0
+        self._evalState.stopReason = STOP_NONE
 
 
+    def setCoordinateOffset(self, double x_offset, double y_offset):
+        '''
+        Set the position of the loaded image inside a larger image, when
+        fitting a subsection of it. The X0 and Y0 parameters, and their
+        limits, are given in the coordinates of the larger image and
+        converted internally. The current parameter values are kept.
+        '''
+        self._acquire()
+        try:
+            self._setCoordinateOffset(x_offset, y_offset)
+        finally:
+            self._release()
+        
+        
+    def _setCoordinateOffset(self, double x_offset, double y_offset):
+        cdef int i
+        for i, param in enumerate(self._parameterList):
+            if param.name == 'X0':
+                offset = x_offset
+            elif param.name == 'Y0':
+                offset = y_offset
+            else:
+                continue
+            self._paramVect[i] += self._paramOffsets[i] - offset
+            self._paramOffsets[i] = offset
+            # Used by the solvers when printing the parameters.
+            self._paramInfo[i].offset = offset
+            if self._paramInfo[i].limited[0]:
+                self._paramInfo[i].limits[0] = param.limits[0] - offset
+                self._paramInfo[i].limits[1] = param.limits[1] - offset
+        self._updateTies()
+        if self._finalSetupDone:
+            self._createBackground()
+        
+        
     cdef _addFunctions(self, object model_descr, bool subsampling, bool verbose=False):
         cdef int status = 0
         status = AddFunctions(self._model, model_descr.functionList(),
@@ -252,21 +517,31 @@ cdef class ModelObjectWrapper(object):
     def setPSF(self, np.ndarray[np.double_t, ndim=2, mode='c'] psf):
         cdef int n_rows_psf, n_cols_psf
 
-        # Maybe this was called before.
-        if self._psfData != NULL:
-            free(self._psfData)
-        self._psfData = alloc_copy_from_ndarray(psf)
-        n_rows_psf = psf.shape[0]
-        n_cols_psf = psf.shape[1]
-        self._model.AddPSFVector(n_cols_psf * n_rows_psf, n_cols_psf, n_rows_psf, self._psfData)
+        self._acquire()
+        try:
+            # Maybe this was called before.
+            if self._psfData != NULL:
+                free(self._psfData)
+            self._psfData = alloc_copy_from_ndarray(psf)
+            n_rows_psf = psf.shape[0]
+            n_cols_psf = psf.shape[1]
+            self._model.AddPSFVector(n_cols_psf * n_rows_psf, n_cols_psf, n_rows_psf, self._psfData)
+        finally:
+            self._release()
         
 
     def loadData(self,
                  np.ndarray[np.double_t, ndim=2, mode='c'] image not None,
                  np.ndarray[np.double_t, ndim=2, mode='c'] error,
                  np.ndarray[np.double_t, ndim=2, mode='c'] mask,
+                 bool copy=True,
                  **kwargs):
-        
+        '''
+        Load the image, error and mask. If ``copy`` is ``False``, the
+        ModelObject uses the memory of the image array directly, and this
+        instance keeps a reference to it. The error and mask are always
+        copied, as the library converts their values in place.
+        '''
         cdef int n_rows, n_cols, n_rows_err, n_cols_err
         cdef int n_pixels
 
@@ -323,6 +598,7 @@ cdef class ModelObjectWrapper(object):
                 raise Exception('Unknown error type: %s' % kwargs['error_type'])
         else:
             error_type = WEIGHTS_ARE_SIGMAS
+        self._errorType = error_type
 
         if 'mask_format' in kwargs:
             if kwargs['mask_format'] == 'zero_is_good':
@@ -333,6 +609,7 @@ cdef class ModelObjectWrapper(object):
                 raise Exception('Unknown mask format: %s' % kwargs['mask_format'])
         else:
             mask_format = MASK_ZERO_IS_GOOD
+        self._maskFormat = mask_format
             
         if 'use_cash_statistics' in kwargs:
             use_cash_statistics = kwargs['use_cash_statistics']
@@ -344,106 +621,473 @@ cdef class ModelObjectWrapper(object):
         else:
             use_model_for_errors = False            
             
-        self._imageData = alloc_copy_from_ndarray(image)
-        self._nRows = image.shape[0]
-        self._nCols = image.shape[1]
-        self._nPixels = self._nRows * self._nCols
+        self._acquire()
+        try:
+            self._ownsData = copy
+            if copy:
+                self._imageData = alloc_copy_from_ndarray(image)
+            else:
+                self._imageRef = image
+                self._imageData = &image[0,0]
+            self._nRows = image.shape[0]
+            self._nCols = image.shape[1]
+            self._nPixels = self._nRows * self._nCols
             
-        self._model.AddImageDataVector(self._imageData, self._nCols, self._nRows)
-        self._model.AddImageCharacteristics(gain, read_noise, exp_time, n_combined, original_sky)
+            self._model.AddImageDataVector(self._imageData, self._nCols, self._nRows)
+            self._model.AddImageCharacteristics(gain, read_noise, exp_time, n_combined, original_sky)
         
-        if use_cash_statistics:
-            self._model.UseCashStatistic()
-        else:
-            if error is not None:
-                self._errorData = alloc_copy_from_ndarray(error)
-                self._model.AddErrorVector(self._nPixels, self._nCols, self._nRows, self._errorData, error_type)
-            elif use_model_for_errors:
-                self._model.UseModelErrors()
-        
-        if mask is not None:
-            self._maskData = alloc_copy_from_ndarray(mask)
-            success = self._model.AddMaskVector(self._nPixels, self._nCols, self._nRows, self._maskData, mask_format)
+            if use_cash_statistics:
+                self._model.UseCashStatistic()
+            else:
+                if error is not None:
+                    self._errorData = alloc_copy_from_ndarray(error)
+                    self._model.AddErrorVector(self._nPixels, self._nCols, self._nRows, self._errorData, error_type)
+                elif use_model_for_errors:
+                    self._model.UseModelErrors()
+        
+            if mask is not None:
+                self._maskData = alloc_copy_from_ndarray(mask)
+                success = self._model.AddMaskVector(self._nPixels, self._nCols, self._nRows, self._maskData, mask_format)
+                if success != 0:
+                    raise Exception('Error adding mask vector, unknown mask format.')
+        finally:
+            self._release()
+        self._inputDataLoaded = True
+
+
+    def reloadData(self,
+                   np.ndarray[np.double_t, ndim=2, mode='c'] image not None,
+                   np.ndarray[np.double_t, ndim=2, mode='c'] error not None,
+                   np.ndarray[np.double_t, ndim=2, mode='c'] mask not None):
+        '''
+        Replace the pixels of the loaded image, error and mask by new
+        ones of the same shape, keeping the functions, parameter info
+        and PSF/FFT setup of this instance. The parameters are reset
+        to the values of the template model.
+        
+        The ModelObject keeps pointers to the data buffers, so the new
+        pixels are copied in place and the error and mask vectors are
+        registered again. Only instances loaded with both error and mask
+        can be reloaded, otherwise the library would keep weights and
+        masks derived from the previous data. An image loaded without
+        copying can only be reloaded with the same array, replacing just
+        the error and mask, as anything else would overwrite the caller's
+        array.
+        '''
+        cdef int imsize = self._nPixels * sizeof(double)
+        cdef int success
+
+        if not self._inputDataLoaded or self._errorData == NULL or self._maskData == NULL:
+            raise RuntimeError('Data can only be reloaded after loading image, error and mask.')
+        if image.shape[0] != self._nRows or image.shape[1] != self._nCols:
+            raise ValueError('Image shape does not match the loaded data.')
+        if error.shape[0] != self._nRows or error.shape[1] != self._nCols:
+            raise ValueError('Error shape does not match the loaded data.')
+        if mask.shape[0] != self._nRows or mask.shape[1] != self._nCols:
+            raise ValueError('Mask shape does not match the loaded data.')
+        if not self._ownsData and &image[0,0] != self._imageData:
+            raise RuntimeError('An image loaded without copying can only be reloaded with the same array.')
+
+        self._acquire()
+        try:
+            if self._ownsData:
+                memcpy(self._imageData, &image[0,0], imsize)
+            memcpy(self._errorData, &error[0,0], imsize)
+            memcpy(self._maskData, &mask[0,0], imsize)
+            self._model.AddErrorVector(self._nPixels, self._nCols, self._nRows, self._errorData, self._errorType)
+            success = self._model.AddMaskVector(self._nPixels, self._nCols, self._nRows, self._maskData, self._maskFormat)
             if success != 0:
                 raise Exception('Error adding mask vector, unknown mask format.')
+            if self._finalSetupDone:
+                # FinalSetupForFitting() allocates new buffers every time it is
+                # called, just apply the new mask to the new weights.
+                self._model.ApplyMask()
+            self._resetParameters()
+        finally:
+            self._release()
 
-        self._inputDataLoaded = True
+
+    def getLoadedData(self):
+        '''
+        Read-only views of the image, weight and mask buffers used by the
+        library, ``None`` for the ones not loaded, to load other instances
+        with the same data. The library converts the errors to weights
+        (``1/sigma^2``, zero for masked pixels) and the mask to ones for
+        good pixels and zeros for bad pixels. The views keep this instance
+        alive, but not its buffers after :meth:`close`.
+        '''
+        if self._imageData == NULL:
+            raise Exception('Data not loaded yet.')
+        self._acquire()
+        try:
+            return (self._bufferView(self._imageData), self._bufferView(self._errorData),
+                    self._bufferView(self._maskData))
+        finally:
+            self._release()
+        
+        
+    cdef object _bufferView(self, double *data):
+        cdef np.ndarray[np.double_t, ndim=2, mode='c'] view
+        cdef np.npy_intp dims[2]
+        if data == NULL:
+            return None
+        dims[0] = self._nRows
+        dims[1] = self._nCols
+        view = np.PyArray_SimpleNewFromData(2, dims, np.NPY_DOUBLE, data)
+        np.set_array_base(view, self)
+        view.setflags(write=False)
+        return view
+
+
+    @property
+    def reloadable(self):
+        return (self._inputDataLoaded and self._ownsData and
+                self._errorData != NULL and self._maskData != NULL)
+
+
+    @property
+    def imageShape(self):
+        if not self._inputDataLoaded:
+            return None
+        return (self._nRows, self._nCols)
 
 
     def setupModelImage(self, shape):
         if self._inputDataLoaded:
             raise Exception('Input data already loaded.')
-        self._nRows = shape[0]
-        self._nCols = shape[1]
-        self._nPixels = self._nRows * self._nCols
-        self._model.SetupModelImage(self._nCols, self._nRows)
-        self._model.CreateModelImage(self._paramVect)
+        self._acquire()
+        try:
+            self._nRows = shape[0]
+            self._nCols = shape[1]
+            self._nPixels = self._nRows * self._nCols
+            self._model.SetupModelImage(self._nCols, self._nRows)
+            with nogil:
+                self._model.CreateModelImage(self._paramVect)
+        finally:
+            self._release()
         self._inputDataLoaded = True
         
         
+    def createModelImage(self, params=None):
+        '''
+        Compute the model image, using the raw parameters ``params``
+        if given, or the current parameters.
+        '''
+        if not self._inputDataLoaded:
+            raise Exception('Model image not set up yet.')
+        self._acquire()
+        try:
+            if params is not None:
+                self._setRawParameters(params)
+            with nogil:
+                self._model.CreateModelImage(self._paramVect)
+        finally:
+            self._release()
+        self._modelImageStale = False
+        
+        
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def createModelImages(self,
+                          np.ndarray[np.double_t, ndim=2, mode='c'] params not None,
+                          np.ndarray[np.double_t, ndim=3, mode='c'] out not None):
+        '''
+        Compute the model image for each row of ``params``, writing them
+        to ``out``. The current parameters are not changed. Runs without
+        the GIL.
+        '''
+        cdef int i, j
+        cdef int n = params.shape[0]
+        cdef double *shifted
+        cdef double *model_image
+        cdef long imsize = self._nPixels * sizeof(double)
+        if params.shape[1] != self._nParams:
+            raise ValueError('Expected %d parameters, got %d.' % (self._nParams, params.shape[1]))
+        if out.shape[0] != n or out.shape[1] != self._nRows or out.shape[2] != self._nCols:
+            raise ValueError('Output array shape does not match the parameters and the model image.')
+        if not self._inputDataLoaded:
+            raise Exception('Model image not set up yet.')
+        shifted = <double *> calloc(self._nParams, sizeof(double))
+        if shifted == NULL:
+            raise MemoryError('Could not allocate parameter values.')
+        self._acquire()
+        try:
+            with nogil:
+                for i in range(n):
+                    for j in range(self._nParams):
+                        shifted[j] = params[i,j] - self._paramOffsets[j]
+                    self._model.CreateModelImage(shifted)
+                    model_image = self._model.GetModelImageVector()
+                    memcpy(&out[i,0,0], model_image, imsize)
+        finally:
+            self._modelImageStale = True
+            self._release()
+            free(shifted)
+        
+        
     def _testCreateModelImage(self, int count=1):
-        for _ from 0 <= _ < count:
-            self._model.CreateModelImage(self._paramVect)
+        cdef int i
+        self._acquire()
+        try:
+            with nogil:
+                for i in range(count):
+                    self._model.CreateModelImage(self._paramVect)
+        finally:
+            self._release()
+        
         
+    def _acquire(self):
+        # Called with the GIL held, so test and set are not interleaved.
+        if self._freed:
+            raise RuntimeError('Objects already freed.')
+        if self._busy:
+            raise RuntimeError('ModelObject already in use by another thread.')
+        self._busy = True
         
-    def fit(self, double ftol=1e-8, int verbose=-1, mode='LM'):
+        
+    def _release(self):
+        self._busy = False
+        
+        
+    def _finalSetup(self):
+        if self._finalSetupDone:
+            return
         status = self._model.FinalSetupForFitting()
         if status < 0:
             raise Exception('Failure in ModelObject::FinalSetupForFitting().')
-        if mode == 'LM':
-            if self._model.UsingCashStatistic():
-                raise Exception('Cannot use Cash statistic with L-M solver.')
-            self._fitStatus = LevMarFit(self._nParams, self._nFreeParams, self._nPixels,
-                                        self._paramVect, self._paramInfo,
-                                        self._model, ftol, self._paramLimitsExist,
-                                        self._fitResult, verbose)
-        elif mode == 'DE':
-            self._fitStatus = DiffEvolnFit(self._nParams, self._paramVect, self._paramInfo,
-                                           self._model, ftol, verbose)
-        elif mode == 'NM':
-            self._fitStatus = NMSimplexFit(self._nParams, self._paramVect, self._paramInfo,
-                                           self._model, ftol, verbose)
-        else:
+        self._finalSetupDone = True
+        self._createBackground()
+        
+        
+    def fit(self, double ftol=1e-8, int verbose=-1, mode='LM', double max_time=0.0, long max_fev=0,
+            callback=None, long callback_interval=1):
+        '''
+        Fit the model to the loaded data. If ``max_time`` (in seconds)
+        or ``max_fev`` are positive, the solver is stopped when the
+        wall time or the number of model evaluations exceed them,
+        keeping the best parameters found so far.
+        
+        If ``callback`` is given, it is called every ``callback_interval``
+        model evaluations as ``callback(params, fitstat, n_evaluations)``.
+        Returning ``True`` stops the fit as if it was cancelled. An exception
+        raised by the callback also stops the fit, and is raised again
+        after the solver returns.
+        '''
+        if mode not in ['LM', 'DE', 'NM']:
             raise Exception('Invalid fit mode: %s' % mode)
-
+        if mode == 'LM' and self._model.UsingCashStatistic():
+            raise Exception('Cannot use Cash statistic with L-M solver.')
+        if callback is not None and callback_interval < 1:
+            raise ValueError('callback_interval must be positive.')
+        self._acquire()
+        try:
+            self._finalSetup()
+            self._evalState.maxEvaluations = max_fev
+            self._evalState.deadline = _wall_time() + max_time if max_time > 0 else 0.0
+            if callback is not None:
+                self._callback = callback
+                self._evalState.callbackInterval = callback_interval
+            self._fit(ftol, verbose, mode)
+        finally:
+            self._model.SetEvaluationHook(NULL, NULL)
+            self._model.ClearStop()
+            self._evalState.cancelRequested = False
+            self._evalState.callbackInterval = 0
+            self._callback = None
+            self._release()
         self._fitMode = mode
         self._fitted = True
+        if self._callbackError is not None:
+            error = self._callbackError
+            self._callbackError = None
+            raise error
+        
+        
+    def cancel(self):
+        '''
+        Request a fit running in another thread to stop. The solver
+        stops at the next model evaluation, keeping the best parameters
+        found so far. Only a running fit or one about to start in the
+        current thread is affected, see :meth:`clearCancel`.
+        '''
+        if not self._freed:
+            self._evalState.cancelRequested = True
+        
+        
+    def clearCancel(self):
+        '''
+        Discard a cancellation requested while no fit was running, which
+        would otherwise stop the next fit at its first model evaluation.
+        '''
+        if not self._freed:
+            self._evalState.cancelRequested = False
+        
+        
+    cdef _fit(self, double ftol, int verbose, mode):
+        cdef int status
+        cdef double t_start = _wall_time()
+        self._evalState.nEvaluations = 0
+        self._evalState.bestFitStatistic = INFINITY
+        self._evalState.stopReason = STOP_NONE
+        self._model.ClearStop()
+        self._model.SetNDeviates(self._nPixels)
+        self._model.SetEvaluationHook(_evaluation_hook, &self._evalState)
+        if mode == 'LM':
+            with nogil:
+                status = LevMarFit(self._nParams, self._nFreeParams, self._nPixels,
+                                   self._paramVect, self._paramInfo,
+                                   self._model, ftol, self._paramLimitsExist,
+                                   self._fitResult, verbose)
+        elif mode == 'DE':
+            with nogil:
+                status = DiffEvolnFit(self._nParams, self._paramVect, self._paramInfo,
+                                      self._model, ftol, verbose)
+        else:
+            with nogil:
+                status = NMSimplexFit(self._nParams, self._paramVect, self._paramInfo,
+                                      self._model, ftol, verbose)
+        self._fitStatus = status
+        # The last model image computed by the solver is not the fitted one.
+        self._modelImageStale = True
+        self._solverTime += _wall_time() - t_start
+        self._nEvaluationsTotal += self._evalState.nEvaluations
+        if self._evalState.stopReason != STOP_NONE and self._evalState.nEvaluations > 0:
+            # The solver result is meaningless after being stopped.
+            memcpy(self._paramVect, self._evalState.bestParams, self._nParams * sizeof(double))
+        # The solvers do not update the tied parameters.
+        self._model.ApplyTies(self._paramVect)
     
     
     def getModelDescription(self):
         model_descr = deepcopy(self._modelDescr)
+        values = self.getRawParameters()
         for i, p in enumerate(model_descr.parameterList()):
-            p.setValue(self._paramVect[i])
+            p.setValue(values[i])
         return model_descr
     
         
+    def setRawParameters(self, values):
+        '''
+        Set the parameter values used as starting point of the next fit,
+        or to compute the model image. The values of tied parameters
+        are ignored, they are computed from the ones they are tied to.
+        '''
+        self._acquire()
+        try:
+            self._setRawParameters(values)
+        finally:
+            self._release()
+        
+        
+    def _setRawParameters(self, values):
+        if len(values) != self._nParams:
+            raise ValueError('Expected %d parameters, got %d.' % (self._nParams, len(values)))
+        for i in xrange(self._nParams):
+            self._paramVect[i] = values[i] - self._paramOffsets[i]
+        self._model.ApplyTies(self._paramVect)
+        self._fitted = False
+        
+        
     def getRawParameters(self):
         vals = []
-        for i in xrange(self._nParams):
-            vals.append(self._paramVect[i])
+        self._acquire()
+        try:
+            for i in xrange(self._nParams):
+                vals.append(self._paramVect[i] + self._paramOffsets[i])
+        finally:
+            self._release()
         return vals
             
             
-    def getModelImage(self):
+    def getModelImage(self, np.ndarray out=None, bool view=False):
+        '''
+        Get the last computed model image.
+        
+        If ``out`` is given, the image is written into it (it can be any
+        array with the right shape, like a memory-mapped one) and ``out``
+        is returned. If ``view`` is ``True``, return a read-only array
+        sharing the memory of the library buffer instead of a copy. The
+        view keeps this instance alive, but its contents change whenever
+        the model image is computed again.
+        '''
+        if self._modelImageStale:
+            self.createModelImage()
+        self._acquire()
+        try:
+            return self._copyModelImage(out, view)
+        finally:
+            self._release()
+        
+        
+    def _copyModelImage(self, np.ndarray out, bool view):
         cdef double *model_image
         cdef np.ndarray[np.double_t, ndim=2, mode='c'] output_array
+        cdef np.npy_intp dims[2]
         cdef int imsize = self._nPixels * sizeof(double)
 
         model_image = self._model.GetModelImageVector()
         if model_image is NULL:
             raise Exception('Error: model image has not yet been computed.')
+        
+        if view or out is not None:
+            dims[0] = self._nRows
+            dims[1] = self._nCols
+            output_array = np.PyArray_SimpleNewFromData(2, dims, np.NPY_DOUBLE, model_image)
+            np.set_array_base(output_array, self)
+            if out is not None:
+                if (<object> out).shape != (self._nRows, self._nCols):
+                    raise ValueError('Output array shape does not match the model image.')
+                out[...] = output_array
+                return out
+            output_array.setflags(write=False)
+            self._views = [v for v in self._views if v() is not None]
+            self._views.append(weakref.ref(output_array))
+            return output_array
+        
         output_array = np.empty((self._nRows, self._nCols), dtype='float64')
         memcpy(&output_array[0,0], model_image, imsize)
 
         return output_array
         
         
+    def getComponentImages(self, np.ndarray out=None, bool convolve=True):
+        '''
+        Compute the image of each function of the model, for the current
+        parameters, as an array of shape ``(n_functions, n_rows, n_cols)``.
+        The functions are evaluated in a single pass over the pixels. If
+        ``convolve`` is ``False``, the images are not convolved with the PSF.
+        If ``out`` is given, the images are written into it (it must be
+        a C-contiguous ``float64`` array) and ``out`` is returned.
+        '''
+        cdef np.ndarray[np.double_t, ndim=3, mode='c'] output_array
+        cdef bool do_convolve = convolve
+        shape = (self._model.GetNComponents(), self._nRows, self._nCols)
+        if not self._inputDataLoaded:
+            raise Exception('Model image not set up yet.')
+        if out is None:
+            out = np.empty(shape, dtype='float64')
+        elif (<object> out).shape != shape:
+            raise ValueError('Output array shape does not match the component images.')
+        output_array = out
+        self._acquire()
+        try:
+            with nogil:
+                self._model.CreateComponentImages(self._paramVect, &output_array[0,0,0], do_convolve)
+        finally:
+            self._release()
+        return out
+        
+        
     def getFitStatistic(self, mode='none'):
         cdef double fitstat
-        if self.fittedLM:
-            fitstat = self._fitResult.bestnorm
-        else:
-            fitstat = self._model.GetFitStatistic(self._paramVect)
+        self._acquire()
+        try:
+            if self.fittedLM and not self.fitStopped:
+                fitstat = self._fitResult.bestnorm
+            else:
+                fitstat = self._model.GetFitStatistic(self._paramVect)
+        finally:
+            self._release()
         cdef int n_valid_pix = self._model.GetNValidPixels()
         cdef int deg_free = n_valid_pix - self._nFreeParams
 
@@ -459,6 +1103,106 @@ cdef class ModelObjectWrapper(object):
             raise Exception('Unknown statistic mode: %s' % mode)
 
 
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def computeFitStatistics(self,
+                             np.ndarray[np.double_t, ndim=2, mode='c'] params not None,
+                             np.ndarray[np.double_t, ndim=1, mode='c'] out not None):
+        '''
+        Compute the fit statistic for each row of ``params`` against the
+        loaded data, writing them to ``out``. Runs without the GIL.
+        '''
+        cdef int i, j
+        cdef int n = params.shape[0]
+        cdef double *shifted
+        if params.shape[1] != self._nParams:
+            raise ValueError('Expected %d parameters, got %d.' % (self._nParams, params.shape[1]))
+        if out.shape[0] != n:
+            raise ValueError('Output array length does not match the number of parameter vectors.')
+        if not self._inputDataLoaded:
+            raise Exception('Data not loaded yet.')
+        shifted = <double *> calloc(self._nParams, sizeof(double))
+        if shifted == NULL:
+            raise MemoryError('Could not allocate parameter values.')
+        self._acquire()
+        try:
+            self._finalSetup()
+            with nogil:
+                for i in range(n):
+                    for j in range(self._nParams):
+                        shifted[j] = params[i,j] - self._paramOffsets[j]
+                    out[i] = self._model.GetFitStatistic(shifted)
+        finally:
+            self._modelImageStale = True
+            self._release()
+            free(shifted)
+        
+        
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def computeDeviates(self,
+                        np.ndarray[np.double_t, ndim=2, mode='c'] params not None,
+                        np.ndarray[np.double_t, ndim=2, mode='c'] out not None):
+        '''
+        Compute the weighted deviates (data minus model, zero for masked
+        pixels) for each row of ``params``, writing them to the rows of
+        ``out``, which must have one column per image pixel. Used by the
+        Python L-M solver. Runs without the GIL.
+        '''
+        cdef int i, j
+        cdef int n = params.shape[0]
+        cdef double *shifted
+        if params.shape[1] != self._nParams:
+            raise ValueError('Expected %d parameters, got %d.' % (self._nParams, params.shape[1]))
+        if out.shape[0] != n or out.shape[1] != self._nPixels:
+            raise ValueError('Output array shape does not match the parameters and the image.')
+        if not self._inputDataLoaded:
+            raise Exception('Data not loaded yet.')
+        if self._model.UsingCashStatistic():
+            raise Exception('Cannot use Cash statistic with L-M solver.')
+        shifted = <double *> calloc(self._nParams, sizeof(double))
+        if shifted == NULL:
+            raise MemoryError('Could not allocate parameter values.')
+        self._acquire()
+        try:
+            self._finalSetup()
+            with nogil:
+                for i in range(n):
+                    for j in range(self._nParams):
+                        shifted[j] = params[i,j] - self._paramOffsets[j]
+                    self._model.ComputeDeviates(&out[i,0], shifted)
+        finally:
+            self._modelImageStale = True
+            self._release()
+            free(shifted)
+        
+        
+    def setFitResult(self, params, int status, mode, bool cancelled=False, bool budget_exceeded=False,
+                     long n_fev=0, int n_iter=-1):
+        '''
+        Store the result of a fit done outside of this instance, by a solver
+        which evaluates the model through other model objects. ``status``
+        follows the same convention as the native solvers.
+        '''
+        self._acquire()
+        try:
+            self._setRawParameters(params)
+            self._finalSetup()
+        finally:
+            self._release()
+        self._fitStatus = status
+        self._evalState.nEvaluations = n_fev
+        self._fitResult.niter = n_iter
+        self._fitMode = mode
+        if cancelled:
+            self._evalState.stopReason = STOP_CANCELLED
+        elif budget_exceeded:
+            self._evalState.stopReason = STOP_MAX_FEV
+        else:
+            self._evalState.stopReason = STOP_NONE
+        self._fitted = True
+
+
     @property
     def fittedLM(self):
         return self._fitted and (self._fitMode == 'LM')
@@ -474,7 +1218,7 @@ cdef class ModelObjectWrapper(object):
     
     @property
     def nIter(self):
-        if self.fittedLM:
+        if self._fitted and self._fitMode in ('LM', 'LM-parallel'):
             return self._fitResult.niter
         else:
             return -1
@@ -484,10 +1228,42 @@ cdef class ModelObjectWrapper(object):
     def nFev(self):
         if self.fittedLM:
             return self._fitResult.nfev
+        elif self._fitted:
+            return self._evalState.nEvaluations
         else:
             return -1
     
     
+    def resetStats(self):
+        '''
+        Reset the performance counters returned by :meth:`getStats`.
+        '''
+        self._acquire()
+        try:
+            self._model.ResetStats()
+        finally:
+            self._release()
+        self._solverTime = 0.0
+        self._nEvaluationsTotal = 0
+        
+        
+    def getStats(self):
+        '''
+        Performance counters accumulated since the creation of this instance
+        or the last call to :meth:`resetStats`, as a dictionary with the
+        number of model images computed (``'nModelImages'``), the time in
+        seconds spent computing them (``'modelTime'``) and convolving them
+        with the PSF (``'convolutionTime'``), the wall time of the solvers
+        (``'solverTime'``) and the number of model evaluations made by them
+        (``'nFev'``).
+        '''
+        return {'nModelImages': self._model.GetNModelImages(),
+                'modelTime': self._model.GetModelTime(),
+                'convolutionTime': self._model.GetConvolutionTime(),
+                'solverTime': self._solverTime,
+                'nFev': self._nEvaluationsTotal}
+    
+    
     @property
     def nValidPixels(self):
         return self._model.GetNValidPixels()
@@ -498,11 +1274,30 @@ cdef class ModelObjectWrapper(object):
         return self._model.GetNValidPixels() / self._nPixels
     
 
+    @property
+    def fitStopped(self):
+        return self._evalState.stopReason != STOP_NONE
+    
+    
+    @property
+    def fitCancelled(self):
+        if not self._fitted:
+            raise Exception('Not fitted yet.')
+        return self._evalState.stopReason == STOP_CANCELLED
+    
+    
+    @property
+    def fitBudgetExceeded(self):
+        if not self._fitted:
+            raise Exception('Not fitted yet.')
+        return self._evalState.stopReason in (STOP_MAX_FEV, STOP_MAX_TIME)
+    
+    
     @property
     def fitConverged(self):
         if not self._fitted:
             raise Exception('Not fitted yet.')
-        return (self._fitStatus > 0) and (self._fitStatus < 5)
+        return (self._fitStatus > 0) and (self._fitStatus < 5) and not self.fitStopped
     
     
     @property
@@ -516,26 +1311,80 @@ cdef class ModelObjectWrapper(object):
     def fitTerminated(self):
         if not self._fitted:
             raise Exception('Not fitted yet.')
-        # See Imfit/src/mpfit.cpp for magic numbers.
-        return self._fitStatus >= 5
+        # See Imfit/src/mpfit.cpp for magic numbers. The Python solvers
+        # return 5 when cancelled, the native ones usually do not.
+        return (self._fitStatus >= 5 and not self.fitCancelled) or self.fitBudgetExceeded
     
     
     def close(self):
+        if self._busy:
+            raise RuntimeError('ModelObject still in use by another thread.')
+        self._freed = True
+        for v in self._views:
+            if v() is not None:
+                # Model image views still alive, they hold a reference
+                # to this instance and __dealloc__ will free everything.
+                return
+        self._free()
+        self._imageRef = None
+        
+        
+    def __dealloc__(self):
+        self._free()
+        
+        
+    cdef _free(self):
         if self._model != NULL:
             del self._model
+            self._model = NULL
         if self._paramInfo != NULL:
             free(self._paramInfo)
+            self._paramInfo = NULL
         if self._paramVect != NULL:
             free(self._paramVect)
+            self._paramVect = NULL
+        if self._paramOffsets != NULL:
+            free(self._paramOffsets)
+            self._paramOffsets = NULL
+        if self._evalState.bestParams != NULL:
+            free(self._evalState.bestParams)
+            self._evalState.bestParams = NULL
             
-        if self._imageData != NULL:
+        if self._ownsData and self._imageData != NULL:
             free(self._imageData)
         if self._errorData != NULL:
             free(self._errorData)
         if self._maskData != NULL:
             free(self._maskData)
+        self._imageData = NULL
+        self._errorData = NULL
+        self._maskData = NULL
         if self._psfData != NULL:
             free(self._psfData)
-        self._freed = True
+            self._psfData = NULL
+        
         
-        
\ No newline at end of file
+################################################################################
+
+cdef int _progress_callback(EvaluationState *state, double *params, double fit_statistic) noexcept with gil:
+    '''
+    Call the progress callback of the wrapper owning ``state``.
+    Returns nonzero to stop the fit.
+    '''
+    cdef ModelObjectWrapper wrapper = <ModelObjectWrapper> state.wrapper
+    cdef np.ndarray[np.double_t, ndim=1, mode='c'] param_array
+    cdef int i
+    # Exceptions cannot propagate through the solvers, they are
+    # stored and raised again after the fit.
+    try:
+        param_array = np.empty(state.nParams, dtype='float64')
+        for i in range(state.nParams):
+            param_array[i] = params[i]
+        wrapper._model.ApplyTies(&param_array[0])
+        for i in range(state.nParams):
+            param_array[i] += wrapper._paramOffsets[i]
+        stop = wrapper._callback(param_array, fit_statistic, state.nEvaluations)
+    except BaseException as e:
+        wrapper._callbackError = e
+        return 1
+    return 1 if stop else 0
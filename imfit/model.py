@@ -11,10 +11,23 @@ __all__ = ['SimpleModelDescription', 'ModelDescription',
 
 ################################################################################
 
+def _getattr_item(container, attr):
+    '''
+    Helper for ``__getattr__``, returning the item ``attr`` of ``container``.
+    Private and special attributes are never items, this keeps pickle and
+    copy from recursing before ``__init__`` has run.
+    '''
+    if attr.startswith('_'):
+        raise AttributeError(attr)
+    return container[attr]
+
+################################################################################
+
 class ParameterDescription(object):
     def __init__(self, name, value, vmin=None, vmax=None, fixed=False):
         self._name = name
         self._limits = None
+        self._tied = None
         self.setValue(value, vmin, vmax, fixed)
         
     
@@ -42,6 +55,47 @@ class ParameterDescription(object):
         return self._limits
     
     
+    @property
+    def tied(self):
+        '''
+        The tie set by :meth:`tie`, as a tuple ``(param, scale, offset)``,
+        or ``None`` if the parameter is not tied.
+        '''
+        return self._tied
+    
+    
+    def tie(self, param, scale=1.0, offset=0.0):
+        '''
+        Tie the value of this parameter to another parameter of the
+        same model, such that ``value = scale * param.value + offset``.
+        A tied parameter is not fitted, which reduces the number of
+        free parameters. Its limits are ignored.
+        
+        Parameters
+        ----------
+        param : :class:`ParameterDescription`
+            The parameter this one follows.
+        
+        scale : float, optional
+            Default: ``1.0``.
+            
+        offset : float, optional
+            Default: ``0.0``.
+        '''
+        if not isinstance(param, ParameterDescription):
+            raise ValueError('param is not a Parameter object.')
+        if param is self:
+            raise ValueError('A parameter cannot be tied to itself.')
+        self._tied = (param, float(scale), float(offset))
+        
+        
+    def untie(self):
+        '''
+        Remove the tie set by :meth:`tie`.
+        '''
+        self._tied = None
+    
+    
     def setValue(self, value, vmin=None, vmax=None, fixed=False):
         '''
         Set the value and constraints to the parameter.
@@ -133,7 +187,9 @@ class ParameterDescription(object):
     
     
     def __str__(self):
-        if self.fixed:
+        if self._tied is not None:
+            return '%s    %f     fixed    # tied to %s' % (self._name, self._value, self._tied[0].name)
+        elif self.fixed:
             return '%s    %f     fixed' % (self._name, self._value)
         elif self.limits is not None:
             return '%s    %f     %f,%f' % (self._name, self._value, self._limits[0], self._limits[1])
@@ -188,7 +244,7 @@ class FunctionDescription(object):
 
     
     def __getattr__(self, attr):
-        return self[attr]
+        return _getattr_item(self, attr)
     
     
     def __getitem__(self, key):
@@ -286,7 +342,7 @@ class FunctionSetDescription(object):
         return '\n'.join(lines)
     
     def __getattr__(self, attr):
-        return self[attr]
+        return _getattr_item(self, attr)
     
     
     def __getitem__(self, key):
@@ -417,7 +473,7 @@ class ModelDescription(object):
         
 
     def __getattr__(self, attr):
-        return self[attr]
+        return _getattr_item(self, attr)
     
     
     def __getitem__(self, key):
@@ -432,6 +488,11 @@ class ModelDescription(object):
     def __deepcopy__(self, memo):
         model = type(self)()
         model._functionSets = deepcopy(self._functionSets, memo)
+        # Tied parameters must refer to the copies.
+        copies = dict((id(p), p_copy) for p, p_copy in zip(self.parameterList(), model.parameterList()))
+        for p in model.parameterList():
+            if p.tied is not None and id(p.tied[0]) in copies:
+                p.tie(copies[id(p.tied[0])], p.tied[1], p.tied[2])
         return model
         
 ################################################################################
@@ -504,4 +565,6 @@ class SimpleModelDescription(ModelDescription):
     
             
     def __getattr__(self, attr):
+        if attr.startswith('_'):
+            raise AttributeError(attr)
         return self._functionSets[0][attr]
@@ -5,9 +5,12 @@ import subprocess
 
 def get_extensions():
     cfg = {}
-    cfg['include_dirs'] = ['numpy']
+    cfg['include_dirs'] = ['numpy', 'imfit/lib']
     cfg['sources'] = ['imfit/lib/lib_wrapper.pyx']
     cfg['language'] = 'c++'
+    # The model object subclass in hooked_model_object.h uses OpenMP.
+    cfg['extra_compile_args'] = ['-fopenmp']
+    cfg['extra_link_args'] = ['-fopenmp']
 
     # FIXME: more portable way to check the libraries.    
     libs_str = subprocess.check_output(['pkg-config', '--libs-only-l', 'imfit'])
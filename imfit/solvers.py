@@ -0,0 +1,257 @@
+'''
+Created on Oct 16, 2026
+
+Solvers implemented in Python, which evaluate the model through
+:class:`~imfit.lib.ModelObjectWrapper` instances instead of calling
+the solvers from the Imfit library. They are used when the model
+evaluations must be spread over several model objects.
+'''
+import numpy as np
+
+__all__ = ['differential_evolution', 'levenberg_marquardt']
+
+################################################################################
+
+def differential_evolution(evaluate, x0, lower, upper, free, ftol=1e-8, pop_factor=10,
+                           scale=0.85, crossover=1.0, max_generations=600, patience=30,
+                           seed=None, stop=None):
+    '''
+    Minimize a fit statistic using Differential Evolution, evaluating
+    a whole generation of the population at once.
+
+    The strategy is the same as the one used by the Imfit library,
+    "rand-to-best/1" with the same default scale and crossover factors.
+
+    Parameters
+    ----------
+    evaluate : callable
+        Function taking a 2-D array of parameter vectors, one per row,
+        and returning an array with the fit statistic of each one.
+
+    x0 : array
+        Initial parameter values. Non-free parameters are kept fixed
+        at these values.
+
+    lower, upper : array
+        Limits of the parameters. Must be finite for all free parameters.
+
+    free : array of bool
+        Flags the parameters to be fitted.
+
+    ftol : float, optional
+        Stop when the relative improvement of the best fit statistic in
+        the last ``patience`` generations is less than ``ftol``.
+        Default: ``1e-8``.
+
+    pop_factor : int, optional
+        Population size, in units of the number of free parameters.
+        Default: ``10``.
+
+    scale : float, optional
+        Differential weight. Default: ``0.85``.
+
+    crossover : float, optional
+        Crossover probability. Default: ``1.0``.
+
+    max_generations : int, optional
+        Maximum number of generations. Default: ``600``.
+
+    patience : int, optional
+        See ``ftol``. Default: ``30``.
+
+    seed : int, optional
+        Random seed. Default: ``None``.
+
+    stop : callable, optional
+        Called before each generation, returning ``True`` stops the fit.
+        Default: ``None``.
+
+    Returns
+    -------
+    params : array
+        Best parameters found.
+
+    fitstat : float
+        Fit statistic of ``params``.
+
+    n_generations : int
+        Number of generations computed.
+
+    status : int
+        ``1`` if converged, ``5`` if the maximum number of generations
+        was reached or the fit was stopped (same convention as the
+        native solvers).
+    '''
+    rng = np.random.RandomState(seed)
+    x0 = np.asarray(x0, dtype='float64')
+    free = np.asarray(free, dtype='bool')
+    if not free.any():
+        raise ValueError('No free parameters to fit.')
+    lower = np.asarray(lower, dtype='float64')[free]
+    upper = np.asarray(upper, dtype='float64')[free]
+    if not (np.isfinite(lower).all() and np.isfinite(upper).all()):
+        raise ValueError('All free parameters must have limits for Differential Evolution.')
+    n_free = free.sum()
+    n_pop = max(pop_factor * n_free, 4)
+
+    def full_params(pop):
+        params = np.empty((len(pop), len(x0)))
+        params[:] = x0
+        params[:, free] = pop
+        return params
+
+    pop = lower + rng.rand(n_pop, n_free) * (upper - lower)
+    pop[0] = np.clip(x0[free], lower, upper)
+    fitness = evaluate(full_params(pop))
+    best = np.argmin(fitness)
+    history = [fitness[best]]
+    status = 5
+
+    for generation in range(1, max_generations + 1):
+        if stop is not None and stop():
+            break
+        r = np.empty((n_pop, 2), dtype='int')
+        for i in range(n_pop):
+            others = rng.choice(n_pop - 1, 2, replace=False)
+            r[i] = others + (others >= i)
+        mutant = pop + scale * (pop[best] - pop) + scale * (pop[r[:, 0]] - pop[r[:, 1]])
+        cross = rng.rand(n_pop, n_free) < crossover
+        cross[np.arange(n_pop), rng.randint(0, n_free, n_pop)] = True
+        trial = np.clip(np.where(cross, mutant, pop), lower, upper)
+
+        trial_fitness = evaluate(full_params(trial))
+        improved = trial_fitness <= fitness
+        pop[improved] = trial[improved]
+        fitness[improved] = trial_fitness[improved]
+        best = np.argmin(fitness)
+
+        history.append(fitness[best])
+        if len(history) > patience:
+            old = history[-patience - 1]
+            if abs(old - history[-1]) <= ftol * abs(old):
+                status = 1
+                break
+
+    params = full_params(pop[best:best + 1])[0]
+    return params, fitness[best], generation, status
+
+################################################################################
+
+def levenberg_marquardt(deviates, x0, lower, upper, free, ftol=1e-8, max_iter=200, stop=None):
+    '''
+    Minimize the sum of squared deviates using the Levenberg-Marquardt
+    algorithm, evaluating all the columns of the forward-difference
+    Jacobian at once.
+
+    The finite difference steps follow the same rules as the solver of
+    the Imfit library (MPFIT), and parameters are kept inside their
+    limits by clipping each step.
+
+    Parameters
+    ----------
+    deviates : callable
+        Function taking a 2-D array of parameter vectors, one per row,
+        and returning a 2-D array with the deviates of each one, one per row.
+
+    x0 : array
+        Initial parameter values. Non-free parameters are kept fixed
+        at these values.
+
+    lower, upper : array
+        Limits of the parameters, may be infinite.
+
+    free : array of bool
+        Flags the parameters to be fitted.
+
+    ftol : float, optional
+        Stop when the relative reduction of the sum of squares in
+        an iteration is less than ``ftol``. Default: ``1e-8``.
+
+    max_iter : int, optional
+        Maximum number of iterations. Default: ``200``.
+
+    stop : callable, optional
+        Called before each iteration, returning ``True`` stops the fit.
+        Default: ``None``.
+
+    Returns
+    -------
+    params : array
+        Best parameters found.
+
+    chi2 : float
+        Sum of squared deviates of ``params``.
+
+    n_iter : int
+        Number of iterations computed.
+
+    status : int
+        ``1`` if converged by ``ftol``, ``2`` if no step reduces the
+        sum of squares, ``5`` if the maximum number of iterations was
+        reached or the fit was stopped (same convention as the native
+        solvers).
+    '''
+    x = np.asarray(x0, dtype='float64').copy()
+    free = np.asarray(free, dtype='bool')
+    if not free.any():
+        raise ValueError('No free parameters to fit.')
+    lower = np.asarray(lower, dtype='float64')[free]
+    upper = np.asarray(upper, dtype='float64')[free]
+    index = np.flatnonzero(free)
+    n_free = len(index)
+    eps = np.sqrt(np.finfo('float64').eps)
+
+    x[index] = np.clip(x[index], lower, upper)
+    f = deviates(x[np.newaxis])[0]
+    chi2 = np.dot(f, f)
+    damping = 1e-3
+    status = 5
+    n_iter = 0
+
+    for n_iter in range(1, max_iter + 1):
+        if stop is not None and stop():
+            break
+        xf = x[index]
+        h = eps * np.abs(xf)
+        h[h == 0] = eps
+        # Step backwards if the forward step crosses the upper limit.
+        h = np.where(xf + h > upper, -h, h)
+        steps = np.tile(x, (n_free, 1))
+        steps[np.arange(n_free), index] += h
+        jac = (deviates(steps) - f) / h[:, np.newaxis]
+        alpha = np.dot(jac, jac.T)
+        beta = np.dot(jac, f)
+        diag = np.diag(alpha).copy()
+        diag[diag == 0] = 1.0
+        # Parameters at a limit and pushed against it are pegged.
+        pegged = ((xf <= lower) & (beta > 0)) | ((xf >= upper) & (beta < 0))
+        moving = ~pegged
+
+        while True:
+            delta = np.zeros(n_free)
+            try:
+                a = alpha[moving][:, moving] + damping * np.diag(diag[moving])
+                delta[moving] = np.linalg.solve(a, -beta[moving])
+            except np.linalg.LinAlgError:
+                delta = None
+            if delta is not None:
+                x_new = x.copy()
+                x_new[index] = np.clip(xf + delta, lower, upper)
+                f_new = deviates(x_new[np.newaxis])[0]
+                chi2_new = np.dot(f_new, f_new)
+                if chi2_new < chi2:
+                    break
+            damping *= 10
+            if damping > 1e10:
+                return x, chi2, n_iter, 2
+
+        converged = chi2 - chi2_new <= ftol * chi2
+        x, f, chi2 = x_new, f_new, chi2_new
+        damping = max(damping / 10, 1e-10)
+        if converged:
+            status = 1
+            break
+
+    return x, chi2, n_iter, status
+
+################################################################################
@@ -5,7 +5,10 @@ Created on 13/03/2014
 '''
 
 from imfit import Imfit, SimpleModelDescription, function_description, gaussian_psf
+from imfit import ModelDescription, FunctionSetDescription
 import numpy as np
+import threading
+import time
 from numpy.testing import assert_allclose
 
 
@@ -32,6 +35,16 @@ def create_model():
     return model
 
 
+def noisy_image(imfit, shape, noise_level=0.1):
+    '''
+    Model image of ``imfit`` with added noise, and the noise image.
+    '''
+    image = imfit.getModelImage(shape)
+    noise = image * noise_level
+    image += (np.random.random(shape) * noise)
+    return image, noise
+
+
 def get_model_param_array(model):
     params = []
     for p in model.parameterList():
@@ -46,9 +59,7 @@ def test_fitting():
 
     noise_level = 0.1
     shape = (100, 100)
-    image = imfit.getModelImage(shape)
-    noise = image * noise_level
-    image += (np.random.random(shape) * noise)
+    image, noise = noisy_image(imfit, shape, noise_level)
     mask = np.zeros_like(image, dtype='bool')
     
     imfit.fit(image, noise, mask)
@@ -60,6 +71,772 @@ def test_fitting():
     assert_allclose(orig_params, fitted_params, rtol=noise_level)
     
 
+def test_fitting_no_copy():
+    psf = gaussian_psf(2.5, size=9)
+    model_orig = create_model()
+    imfit = Imfit(model_orig, psf=psf, quiet=True)
+
+    shape = (100, 100)
+    image, noise = noisy_image(imfit, shape)
+    mask = np.zeros(shape)
+    mask[:10] = 1
+    
+    imfit.fit(image, noise, mask)
+    params = imfit.getRawParameters()
+    fitstat = imfit.fitStatistic
+    
+    input_noise, input_mask = noise.copy(), mask.copy()
+    imfit_nocopy = Imfit(model_orig, psf=psf, quiet=True)
+    imfit_nocopy.fit(image, input_noise, input_mask, copy=False)
+    assert_allclose(imfit_nocopy.getRawParameters(), params)
+    assert_allclose(imfit_nocopy.fitStatistic, fitstat)
+    
+    # Only the image is shared, the error and mask are left untouched.
+    loaded_image, weight, loaded_mask = imfit_nocopy._modelObject.getLoadedData()
+    assert np.shares_memory(loaded_image, image)
+    assert not np.shares_memory(weight, input_noise)
+    assert not np.shares_memory(loaded_mask, input_mask)
+    assert np.array_equal(input_noise, noise)
+    assert np.array_equal(input_mask, mask)
+    
+    # A borrowed image is only reloaded with the same array.
+    imfit_nocopy._modelObject.reloadData(image, noise, mask)
+    try:
+        imfit_nocopy._modelObject.reloadData(image.copy(), noise, mask)
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError('Borrowed image overwritten.')
+    
+    # Other types are converted.
+    imfit_nocopy.fit(image.astype('float32'), noise, mask, copy=False)
+    assert not np.shares_memory(imfit_nocopy._modelObject.getLoadedData()[0], image)
+    
+
+def test_fitting_persistent():
+    psf = gaussian_psf(2.5, size=9)
+    model_orig = create_model()
+    imfit = Imfit(model_orig, psf=psf, quiet=True, persistent=True)
+
+    noise_level = 0.1
+    shape = (100, 100)
+    image = imfit.getModelImage(shape)
+    noise = image * noise_level
+    orig_params = get_model_param_array(model_orig)
+    
+    model_object = None
+    for _ in range(3):
+        noisy_image = image + (np.random.random(shape) * noise)
+        imfit.fit(noisy_image, noise)
+        if model_object is None:
+            model_object = imfit._modelObject
+        else:
+            assert imfit._modelObject is model_object
+        fitted_params = get_model_param_array(imfit.getModelDescription())
+        assert_allclose(orig_params, fitted_params, rtol=noise_level)
+    
+    # Cancelling while no fit is running does not affect the next one.
+    imfit.cancel()
+    imfit.fit(noisy_image, noise)
+    assert imfit._modelObject is model_object
+    assert imfit.fitConverged
+    assert not imfit.fitCancelled
+    
+
+def test_fit_many():
+    psf = gaussian_psf(2.5, size=9)
+    model_orig = create_model()
+    imfit = Imfit(model_orig, psf=psf, quiet=True)
+
+    noise_level = 0.1
+    shape = (100, 100)
+    image = imfit.getModelImage(shape)
+    noise = image * noise_level
+    images = [image + (np.random.random(shape) * noise) for _ in range(4)]
+    errors = [noise] * len(images)
+    
+    results = imfit.fit_many(images, errors, workers=2)
+    assert len(results) == len(images)
+    orig_params = get_model_param_array(model_orig)
+    for i, result in enumerate(results):
+        imfit.fit(images[i], noise)
+        assert_allclose(result.rawParameters, imfit.getRawParameters())
+        fitted_params = get_model_param_array(result.modelDescr)
+        assert_allclose(orig_params, fitted_params, rtol=noise_level)
+    
+
+def test_fit_async_cancel():
+    model_orig = create_model()
+    imfit = Imfit(model_orig, quiet=True)
+
+    shape = (100, 100)
+    image, noise = noisy_image(imfit, shape)
+    
+    result = imfit.fit_async(image, noise, mode='LM').result()
+    assert not result.fitCancelled
+    assert_allclose(result.rawParameters, imfit.getRawParameters())
+    
+    # Cancel while the fit is blocked in its first progress callback.
+    started = threading.Event()
+    cancelled = threading.Event()
+    def progress(params, fitstat, n_evaluations):
+        started.set()
+        cancelled.wait(10.0)
+
+    future = imfit.fit_async(image, noise, mode='DE', callback=progress)
+    assert started.wait(10.0)
+    imfit.cancel()
+    cancelled.set()
+    result = future.result()
+    assert result.fitCancelled
+    assert not result.fitConverged
+    assert np.isfinite(result.fitStatistic)
+
+
+def test_concurrent_fits():
+    model_orig = create_model()
+    imfit = Imfit(model_orig, quiet=True)
+
+    noise_level = 0.1
+    shape = (100, 100)
+    image = imfit.getModelImage(shape)
+    noise = image * noise_level
+    images = [image + (np.random.random(shape) * noise) for _ in range(2)]
+    
+    serial = []
+    for im in images:
+        imfit.fit(im, noise)
+        serial.append(imfit.getRawParameters())
+    
+    # Separate instances can be used concurrently.
+    instances = [Imfit(model_orig, quiet=True) for _ in images]
+    threads = [threading.Thread(target=instance.fit, args=(im, noise))
+               for instance, im in zip(instances, images)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    for instance, params in zip(instances, serial):
+        assert_allclose(instance.getRawParameters(), params)
+    
+    # Using an instance while it is fitting raises.
+    started = threading.Event()
+    checked = threading.Event()
+    def callback(params, fitstat, n_evaluations):
+        started.set()
+        checked.wait()
+    future = imfit.fit_async(images[0], noise, mode='DE', callback=callback, callback_interval=1)
+    started.wait()
+    try:
+        for func in [lambda: imfit.fitStatistic, imfit.getRawParameters,
+                     lambda: imfit._modelObject.setRawParameters(serial[0])]:
+            try:
+                func()
+            except RuntimeError:
+                pass
+            else:
+                raise AssertionError('Instance used during a fit.')
+    finally:
+        imfit.cancel()
+        checked.set()
+    assert future.result().fitCancelled
+
+
+def test_model_image_out_view():
+    model_orig = create_model()
+    imfit = Imfit(model_orig, quiet=True)
+    shape = (100, 100)
+    image = imfit.getModelImage(shape)
+    
+    out = np.zeros(shape)
+    assert imfit.getModelImage(out=out) is out
+    assert_allclose(out, image)
+    
+    view = imfit.getModelImage(view=True)
+    assert not view.flags.writeable
+    assert_allclose(view, image)
+    del imfit
+    assert_allclose(view, image)
+
+
+def test_fit_sequence():
+    psf = gaussian_psf(2.5, size=9)
+    model_orig = create_model()
+    imfit = Imfit(model_orig, psf=psf, quiet=True)
+
+    noise_level = 0.1
+    shape = (100, 100)
+    image = imfit.getModelImage(shape)
+    noise = image * noise_level
+    cube = np.array([image + (np.random.random(shape) * noise) for _ in range(3)])
+    
+    results = imfit.fitSequence(cube, [noise] * len(cube))
+    assert len(results) == len(cube)
+    assert not results[0].warmStart
+    orig_params = get_model_param_array(model_orig)
+    for result in results:
+        fitted_params = get_model_param_array(result.modelDescr)
+        assert_allclose(orig_params, fitted_params, rtol=noise_level)
+    
+    # The native model object is reused, also without persistent mode.
+    model_objects = []
+    def callback(params, fitstat, n_evaluations):
+        model_objects.append(imfit._modelObject)
+    results = imfit.fitSequence(cube, [noise] * len(cube), callback=callback, callback_interval=5)
+    assert len(set(id(m) for m in model_objects)) == 1
+    assert imfit.stats.nFev > 0
+
+
+def test_fitting_multistart():
+    psf = gaussian_psf(2.5, size=9)
+    model_orig = create_model()
+    imfit = Imfit(model_orig, psf=psf, quiet=True)
+
+    noise_level = 0.1
+    shape = (100, 100)
+    image, noise = noisy_image(imfit, shape, noise_level)
+    
+    n_starts = 6
+    imfit.fit(image, noise, mode='LM-multistart', n_starts=n_starts, workers=2, seed=42)
+    assert imfit.multistartParameters.shape == (n_starts, len(model_orig.parameterList()))
+    assert_allclose(imfit.fitStatistic, imfit.multistartFitStatistics.min())
+    orig_params = get_model_param_array(model_orig)
+    fitted_params = get_model_param_array(imfit.getModelDescription())
+    assert_allclose(orig_params, fitted_params, rtol=noise_level)
+
+
+def test_fitting_parallel_de():
+    model_orig = create_model()
+    imfit = Imfit(model_orig, quiet=True)
+
+    noise_level = 0.1
+    shape = (50, 50)
+    image, noise = noisy_image(imfit, shape, noise_level)
+    
+    imfit.fit(image, noise, mode='DE-parallel', workers=2, seed=42)
+    assert imfit.fitConverged
+    orig_params = get_model_param_array(model_orig)
+    fitted_params = get_model_param_array(imfit.getModelDescription())
+    assert_allclose(orig_params, fitted_params, rtol=noise_level)
+    
+    # Cancelled fits are reported the same way as the native ones.
+    for mode in ['DE', 'DE-parallel']:
+        imfit.fit(image, noise, mode=mode, callback=lambda p, f, n: n >= 10)
+        assert imfit.fitCancelled
+        assert not imfit.fitTerminated
+    
+    from imfit.solvers import differential_evolution
+    x0 = np.zeros(3)
+    try:
+        differential_evolution(None, x0, x0 - 1, x0 + 1, np.zeros(3, dtype='bool'))
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('Fit without free parameters accepted.')
+
+
+def test_fitting_parallel_lm():
+    model_orig = create_model()
+    imfit = Imfit(model_orig, quiet=True)
+
+    shape = (50, 50)
+    image, noise = noisy_image(imfit, shape)
+    
+    imfit.fit(image, noise)
+    fitstat = imfit.fitStatistic
+    lm_params = imfit.getRawParameters()
+    
+    imfit.fit(image, noise, mode='LM-parallel', workers=2)
+    assert imfit.fitConverged
+    assert imfit.nIter > 0
+    assert_allclose(imfit.getRawParameters(), lm_params, rtol=1e-3)
+    assert_allclose(imfit.fitStatistic, fitstat, rtol=1e-4)
+    
+    from imfit.solvers import levenberg_marquardt
+    x0 = np.zeros(3)
+    try:
+        levenberg_marquardt(None, x0, x0 - 1, x0 + 1, np.zeros(3, dtype='bool'))
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('Fit without free parameters accepted.')
+
+
+def test_bootstrap():
+    model_orig = create_model()
+    imfit = Imfit(model_orig, quiet=True)
+
+    shape = (50, 50)
+    image, noise = noisy_image(imfit, shape)
+    imfit.fit(image, noise)
+    
+    n_iter = 8
+    samples = imfit.bootstrap(n_iter, workers=2, seed=42)
+    assert samples.shape == (n_iter, len(model_orig.parameterList()))
+    assert np.isfinite(samples).all()
+    assert (samples.std(axis=0) > 0).any()
+    assert_allclose(samples, imfit.bootstrap(n_iter, workers=3, seed=42))
+
+
+def test_fitting_budget():
+    model_orig = create_model()
+    imfit = Imfit(model_orig, quiet=True)
+
+    shape = (50, 50)
+    image, noise = noisy_image(imfit, shape)
+    
+    for mode in ['LM', 'DE', 'NM']:
+        imfit.fit(image, noise, mode=mode, max_fev=20)
+        assert imfit.fitBudgetExceeded
+        assert imfit.fitTerminated
+        assert not imfit.fitConverged
+        assert np.isfinite(imfit.fitStatistic)
+    
+    t1 = time.time()
+    imfit.fit(image, noise, mode='DE', max_time=0.5)
+    assert time.time() - t1 < 5.0
+    assert imfit.fitBudgetExceeded
+
+
+def test_fitting_callback():
+    model_orig = create_model()
+    imfit = Imfit(model_orig, quiet=True)
+
+    shape = (50, 50)
+    image, noise = noisy_image(imfit, shape)
+    
+    calls = []
+    def progress(params, fitstat, n_evaluations):
+        calls.append((params, fitstat, n_evaluations))
+
+    imfit.fit(image, noise, mode='LM', callback=progress, callback_interval=5)
+    assert len(calls) > 0
+    assert all(n % 5 == 0 for _, _, n in calls)
+    assert len(calls[0][0]) == len(imfit.getRawParameters())
+    assert not imfit.fitCancelled
+    
+    imfit.fit(image, noise, mode='NM', callback=lambda p, f, n: n >= 10)
+    assert imfit.fitCancelled
+    
+    def failing(params, fitstat, n_evaluations):
+        raise KeyError('stop')
+    try:
+        imfit.fit(image, noise, mode='DE', callback=failing)
+    except KeyError:
+        pass
+    else:
+        raise AssertionError('Callback exception not raised.')
+
+
+def test_fit_stats():
+    model_orig = create_model()
+    imfit = Imfit(model_orig, quiet=True)
+    assert imfit.stats is None
+
+    shape = (50, 50)
+    image, noise = noisy_image(imfit, shape)
+    
+    for mode in ['LM', 'DE', 'NM']:
+        imfit.fit(image, noise, mode=mode)
+        stats = imfit.stats
+        assert imfit.nFev > 0
+        assert stats.nFev == imfit.nFev
+        assert stats.nModelImages >= stats.nFev
+        assert stats.modelTime > 0.0
+        assert stats.convolutionTime == 0.0
+        assert stats.solverTime >= stats.modelTime
+        assert stats.solverOverhead >= 0.0
+        assert stats.loadTime > 0.0
+
+
+def test_autotune():
+    import os, json, tempfile
+    from imfit.tuning import autotune, tuned_settings
+    
+    model_orig = create_model()
+    shape = (50, 50)
+    cache_dir = tempfile.mkdtemp()
+    cache_file = os.path.join(cache_dir, 'autotune.json')
+    assert tuned_settings(model_orig, shape, cache_file=cache_file) is None
+
+    settings, timings = autotune(model_orig, shape, nproc_values=[1, 2], chunk_sizes=[8, 16],
+                                 min_time=0.01, cache_file=cache_file)
+    assert len(timings) == 4
+    assert settings in timings
+    assert tuned_settings(model_orig, shape, cache_file=cache_file) == settings
+    assert tuned_settings(model_orig, (60, 50), cache_file=cache_file) is None
+    with open(cache_file) as f:
+        assert len(json.load(f)) == 1
+    # The file is read only once.
+    os.rename(cache_file, cache_file + '.bak')
+    assert tuned_settings(model_orig, shape, cache_file=cache_file) == settings
+    os.rename(cache_file + '.bak', cache_file)
+    
+    os.environ['IMFIT_TUNING_CACHE'] = cache_file
+    try:
+        imfit = Imfit(model_orig, quiet=True)
+        assert imfit._threadSettings(None, shape) == settings
+        assert imfit._threadSettings(1, shape) == (1, settings[1])
+        imfit = Imfit(model_orig, quiet=True, nproc=3, chunk_size=5)
+        assert imfit._threadSettings(None, shape) == (3, 5)
+        imfit.getModelImage(shape)
+    finally:
+        del os.environ['IMFIT_TUNING_CACHE']
+
+
+def test_fitting_region():
+    model_orig = create_model()
+    imfit = Imfit(model_orig, quiet=True)
+
+    shape = (100, 100)
+    image, noise = noisy_image(imfit, shape)
+    
+    # Embed the image in a larger one, away from the origin.
+    big_image = np.zeros((300, 400))
+    big_noise = np.ones((300, 400))
+    big_image[120:220, 230:330] = image
+    big_noise[120:220, 230:330] = noise
+    model_shifted = create_model()
+    model_shifted.x0.setValue(280, vmin=270, vmax=290)
+    model_shifted.y0.setValue(170, vmin=160, vmax=180)
+    
+    imfit.fit(image, noise)
+    full_params = imfit.getRawParameters()
+    
+    imfit_region = Imfit(model_shifted, quiet=True)
+    imfit_region.fit(big_image, big_noise, region=(120, 220, 230, 330))
+    region_params = imfit_region.getRawParameters()
+    assert imfit_region.getModelImage().shape == shape
+    assert_allclose(region_params[:2], full_params[:2] + [230, 120], rtol=1e-5)
+    assert_allclose(region_params[2:], full_params[2:], rtol=1e-5)
+    assert_allclose(imfit_region.fitStatistic, imfit.fitStatistic, rtol=1e-5)
+    model_fitted = imfit_region.getModelDescription()
+    assert_allclose(model_fitted.x0.value, region_params[0])
+    
+    # Images with a given shape, and later fits, do not keep the region offset.
+    big_shape = big_image.shape
+    big_model_image = imfit_region.getModelImage(big_shape, params=region_params)
+    assert_allclose(big_model_image[120:220, 230:330], imfit_region.getModelImage(), rtol=1e-6)
+    imfit_region.fit(big_image, big_noise)
+    assert imfit_region.getModelImage().shape == big_shape
+    assert_allclose(imfit_region.getModelImage(),
+                    imfit_region.getModelImage(big_shape, params=imfit_region.getRawParameters()))
+    assert_allclose(imfit_region.getRawParameters()[:2], region_params[:2], rtol=1e-2)
+    
+    try:
+        imfit_region.fit(big_image, big_noise, region=(250, 350, 0, 100))
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('Region outside the image accepted.')
+
+
+def test_model_image_tiled():
+    import os, tempfile
+    from astropy.io import fits
+    
+    psf = gaussian_psf(2.5, size=9)
+    model_orig = create_model()
+    imfit = Imfit(model_orig, psf=psf, quiet=True)
+    shape = (100, 120)
+    image = imfit.getModelImage(shape)
+    
+    imfit = Imfit(model_orig, psf=psf, quiet=True)
+    tiled = imfit.getModelImageTiled(shape, tile_size=32)
+    assert_allclose(tiled, image, rtol=1e-6, atol=1e-10)
+    
+    tmp_dir = tempfile.mkdtemp()
+    out = np.memmap(os.path.join(tmp_dir, 'model.dat'), dtype='float64', mode='w+', shape=shape)
+    result = imfit.getModelImageTiled(shape, out=out, tile_size=(40, 50), workers=2)
+    assert result is out
+    assert_allclose(out, image, rtol=1e-6, atol=1e-10)
+    
+    fits_file = os.path.join(tmp_dir, 'model.fits')
+    assert imfit.getModelImageTiled(shape, out=fits_file, tile_size=64, workers=2) == fits_file
+    assert_allclose(fits.getdata(fits_file), image, rtol=1e-6, atol=1e-10)
+    try:
+        imfit.getModelImageTiled(shape, out=fits_file)
+    except OSError:
+        pass
+    else:
+        raise AssertionError('Existing file overwritten.')
+    imfit.getModelImageTiled((50, 60), out=fits_file, overwrite=True)
+    assert fits.getdata(fits_file).shape == (50, 60)
+
+
+def test_fitting_tied():
+    from copy import deepcopy
+
+    model_orig = create_model()
+    model_orig.disk.PA.setValue(45, vmin=30, vmax=60)
+    imfit = Imfit(model_orig, quiet=True)
+    shape = (100, 100)
+    image, noise = noisy_image(imfit, shape)
+
+    model_tied = create_model()
+    model_tied.disk.PA.tie(model_tied.bulge.PA)
+    model_tied.disk.h.tie(model_tied.bulge.r_e, scale=1.5)
+    model_copy = deepcopy(model_tied)
+    assert model_copy.disk.PA.tied[0] is model_copy.bulge.PA
+    assert model_copy.disk.h.tied[1] == 1.5
+    
+    imfit = Imfit(model_tied, quiet=True)
+    imfit.fit(image, noise)
+    assert imfit.fitConverged
+    model_fitted = imfit.getModelDescription()
+    assert_allclose(model_fitted.disk.PA.value, model_fitted.bulge.PA.value)
+    assert_allclose(model_fitted.disk.h.value, 1.5 * model_fitted.bulge.r_e.value)
+    
+    model_tied.x0.setValue(50, vmin=40, vmax=60)
+    model_tied.y0.tie(model_tied.x0)
+    imfit.fit(image, noise, region=(10, 90, 20, 80))
+    model_fitted = imfit.getModelDescription()
+    assert_allclose(model_fitted.y0.value, model_fitted.x0.value)
+    assert_allclose(model_fitted.disk.PA.value, model_fitted.bulge.PA.value)
+    
+    model_circular = create_model()
+    model_circular.disk.PA.tie(model_circular.bulge.PA)
+    model_circular.bulge.PA.tie(model_circular.disk.PA)
+    try:
+        Imfit(model_circular).getModelImage(shape)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('Circular tie accepted.')
+
+
+def test_model_image_cache():
+    psf = gaussian_psf(2.5, size=9)
+    model_orig = create_model()
+    shape = (50, 60)
+    image_size = shape[0] * shape[1] * 8
+    imfit = Imfit(model_orig, psf=psf, quiet=True, cache_size=2 * image_size)
+    image = imfit.getModelImage(shape)
+    params = imfit.getRawParameters()
+    
+    image1 = imfit.getModelImage(shape, params=params)
+    assert_allclose(image1, image)
+    assert imfit._imageCache.misses == 1
+    image2 = imfit.getModelImage(shape, params=params, view=True)
+    assert imfit._imageCache.hits == 1
+    assert not image2.flags.writeable
+    assert_allclose(image2, image)
+    # Returned copies do not change the cached image.
+    image1[...] = 0.0
+    assert_allclose(imfit.getModelImage(shape, params=params), image)
+    
+    for scale in [1.1, 1.2, 1.3]:
+        other_params = params.copy()
+        other_params[2:] *= scale
+        imfit.getModelImage(shape, params=other_params)
+    assert imfit._imageCache.nBytes <= 2 * image_size
+    assert len(imfit._imageCache._images) == 2
+    hits = imfit._imageCache.hits
+    imfit.getModelImage(shape, params=params)
+    assert imfit._imageCache.hits == hits
+    
+    # The fitted model is not changed.
+    assert_allclose(imfit.getRawParameters(), params)
+    imfit.clearModelImageCache()
+    assert imfit._imageCache.nBytes == 0
+
+
+def test_component_images():
+    psf = gaussian_psf(2.5, size=9)
+    model_orig = create_model()
+    imfit = Imfit(model_orig, psf=psf, quiet=True)
+    shape = (80, 100)
+    image = imfit.getModelImage(shape)
+    
+    components = imfit.getComponentImages()
+    assert components.shape == (2,) + shape
+    assert_allclose(components.sum(axis=0), image, rtol=1e-6, atol=1e-10)
+    
+    bulge_only = create_model()
+    bulge_only.disk.I_0.setValue(0.0)
+    bulge_image = Imfit(bulge_only, psf=psf).getModelImage(shape)
+    assert_allclose(components[0], bulge_image, rtol=1e-6, atol=1e-10)
+    
+    out = np.empty((2,) + shape)
+    result = imfit.getComponentImages(shape, convolve=False, out=out)
+    assert result is out
+    unconvolved = Imfit(model_orig, quiet=True).getModelImage(shape)
+    assert_allclose(out.sum(axis=0), unconvolved, rtol=1e-6, atol=1e-10)
+    
+    images = imfit.getComponentImages(as_dict=True)
+    assert list(images.keys()) == ['bulge', 'disk']
+    assert_allclose(images['disk'], components[1])
+
+
+def test_render_batch():
+    psf = gaussian_psf(2.5, size=9)
+    model_orig = create_model()
+    imfit = Imfit(model_orig, psf=psf, quiet=True)
+    shape = (40, 50)
+    imfit.getModelImage(shape)
+    params = np.array([imfit.getRawParameters()] * 5)
+    params[:, 0] += np.arange(5)
+    
+    images = imfit.render_batch(params, workers=2)
+    assert images.shape == (5,) + shape
+    for i in range(5):
+        assert_allclose(images[i], imfit.getModelImage(shape, params=params[i]), rtol=1e-6, atol=1e-10)
+    
+    out = np.empty((5, 30, 30))
+    assert imfit.render_batch(params, shape=(30, 30), out=out, workers=1) is out
+    assert_allclose(out[2], imfit.getModelImage((30, 30), params=params[2]), rtol=1e-6, atol=1e-10)
+    assert_allclose(imfit.getRawParameters(), params[0])
+
+
+def test_loglike():
+    model_orig = create_model()
+    imfit = Imfit(model_orig, quiet=True)
+
+    shape = (50, 50)
+    image, noise = noisy_image(imfit, shape)
+    
+    imfit.fit(image, noise, mode='NM')
+    best = imfit.getRawParameters()
+    fitstat = imfit.fitStatistic
+    assert_allclose(imfit.loglike(best), -0.5 * fitstat, rtol=1e-10)
+    
+    params = np.array([best] * 6)
+    params[:, 0] += np.linspace(-2, 2, 6)
+    loglike = imfit.loglike(params)
+    assert loglike.shape == (6,)
+    assert_allclose(imfit.loglike(params, workers=3), loglike, rtol=1e-10)
+    assert np.all(loglike <= -0.5 * fitstat * (1 - 1e-6))
+    assert_allclose(imfit.getRawParameters(), best)
+    assert_allclose(imfit.fitStatistic, fitstat)
+    assert_allclose(imfit.getModelImage(), Imfit(imfit.getModelDescription()).getModelImage(shape),
+                    rtol=1e-6, atol=1e-10)
+    
+    other = Imfit(model_orig, quiet=True)
+    other.loadData(image, noise)
+    assert_allclose(other.loglike(params), loglike, rtol=1e-10)
+    
+    # The parallel evaluations use the loaded data, not the input arrays.
+    mask = np.zeros(shape)
+    mask[:10] = 1
+    for copy in [True, False]:
+        other = Imfit(model_orig, quiet=True)
+        input_image, input_noise = image.copy(), noise.copy()
+        other.loadData(input_image, input_noise, mask.copy(), copy=copy)
+        loglike = other.loglike(params)
+        if copy:
+            input_image[:] = 0
+            input_noise[:] = 1
+        assert_allclose(other.loglike(params, workers=3), loglike, rtol=1e-10)
+
+
+def test_evaluate_grid():
+    model_orig = create_model()
+    imfit = Imfit(model_orig, quiet=True)
+
+    shape = (50, 50)
+    image, noise = noisy_image(imfit, shape)
+    
+    model_start = create_model()
+    model_start.bulge.n.setValue(3.2, vmin=3, vmax=5)
+    model_start.bulge.r_e.setValue(6, vmin=5, vmax=15)
+    imfit = Imfit(model_start, quiet=True)
+    imfit.loadData(image, noise)
+    n_values = np.linspace(3, 5, 5)
+    r_e_values = np.linspace(6, 14, 5)
+    grid = [model_start.bulge.n, model_start.bulge.r_e]
+    
+    cube = imfit.evaluateGrid(grid, [n_values, r_e_values])
+    assert cube.shape == (5, 5)
+    i, j = np.unravel_index(np.argmin(cube), cube.shape)
+    assert (n_values[i], r_e_values[j]) == (4.0, 10.0)
+    assert_allclose(imfit.evaluateGrid(grid, [n_values, r_e_values], workers=3), cube)
+    
+    points = np.array([[3.5, 8.0], [4.0, 10.0]])
+    fitstats = imfit.evaluateGrid(grid, points)
+    assert_allclose(fitstats[1], cube[2, 2])
+    
+    profiled = imfit.evaluateGrid(grid, points, profile=True, workers=2)
+    assert np.all(profiled <= fitstats)
+    
+    stats = imfit.stats
+    imfit.evaluateGrid(grid, [n_values, r_e_values], fit=True)
+    assert imfit.fitConverged
+    assert imfit.stats is not stats
+    assert imfit.stats.nFev > 0
+    model_fitted = imfit.getModelDescription()
+    assert_allclose(model_fitted.bulge.n.value, 4.0, rtol=0.05)
+    assert_allclose(model_fitted.bulge.r_e.value, 10.0, rtol=0.05)
+
+
+def test_incremental_rendering():
+    psf = gaussian_psf(2.5, size=9)
+    model_orig = create_model()
+    shape = (80, 100)
+    imfit = Imfit(model_orig, psf=psf, quiet=True)
+    imfit_inc = Imfit(model_orig, psf=psf, quiet=True, incremental=True)
+    assert_allclose(imfit_inc.getModelImage(shape), imfit.getModelImage(shape))
+
+    # Change only the disk, then only the common center.
+    params = get_model_param_array(model_orig)
+    params[-1] = 0.3
+    assert_allclose(imfit_inc.getModelImage(shape, params=params),
+                    imfit.getModelImage(shape, params=params))
+    params[0] = 52
+    assert_allclose(imfit_inc.getModelImage(shape, params=params),
+                    imfit.getModelImage(shape, params=params))
+
+    image, noise = noisy_image(imfit, shape)
+    imfit.fit(image, noise)
+    imfit_inc.fit(image, noise)
+    assert_allclose(imfit_inc.getRawParameters(), imfit.getRawParameters())
+    assert_allclose(imfit_inc.fitStatistic, imfit.fitStatistic)
+
+
+def test_fixed_components():
+    psf = gaussian_psf(2.5, size=9)
+    galaxy = FunctionSetDescription('galaxy')
+    galaxy.x0.setValue(50, vmin=40, vmax=60)
+    galaxy.y0.setValue(50, vmin=40, vmax=60)
+    disk = function_description('Exponential', name='disk')
+    disk.I_0.setValue(0.7, vmin=0.4, vmax=0.9)
+    disk.h.setValue(15, vmin=10, vmax=20)
+    disk.PA.setValue(60, vmin=45, vmax=90)
+    disk.ell.setValue(0.2, vmin=0, vmax=0.5)
+    galaxy.addFunction(disk)
+    
+    star = FunctionSetDescription('star')
+    star.x0.setValue(20, fixed=True)
+    star.y0.setValue(70, fixed=True)
+    gaussian = function_description('Gaussian', name='star')
+    gaussian.I_0.setValue(5.0, fixed=True)
+    gaussian.sigma.setValue(1.5, fixed=True)
+    gaussian.PA.setValue(0.0, fixed=True)
+    gaussian.ell.setValue(0.0, fixed=True)
+    star.addFunction(gaussian)
+    model_orig = ModelDescription([galaxy, star])
+    
+    imfit = Imfit(model_orig, psf=psf, quiet=True)
+    shape = (100, 100)
+    noise_level = 0.1
+    image, noise = noisy_image(imfit, shape, noise_level)
+    imfit.fit(image, noise)
+    assert imfit._modelObject.nFixedComponents == 1
+    assert imfit.fitConverged
+    orig_params = get_model_param_array(model_orig)
+    fitted_params = get_model_param_array(imfit.getModelDescription())
+    assert_allclose(orig_params, fitted_params, rtol=noise_level)
+    
+    reference = Imfit(model_orig, psf=psf, quiet=True)
+    params = imfit.getRawParameters()
+    assert_allclose(imfit.getModelImage(), reference.getModelImage(shape, params=params),
+                    rtol=1e-6, atol=1e-10)
+    
+    # The background is not used for other values of the fixed parameters.
+    params[-4] = 2.0
+    imfit._modelObject.createModelImage(params)
+    assert_allclose(imfit._modelObject.getModelImage(), reference.getModelImage(shape, params=params),
+                    rtol=1e-6, atol=1e-10)
+
+
 if __name__ == '__main__':
     test_fitting()
-    
\ No newline at end of file
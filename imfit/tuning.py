@@ -0,0 +1,211 @@
+'''
+Created on Oct 16, 2026
+
+Benchmark the model image computation to choose the number of threads
+and the OpenMP chunk size. The results are kept in a cache file, used
+by :class:`~imfit.Imfit` when ``nproc`` or ``chunk_size`` are not set.
+'''
+from multiprocessing import cpu_count
+import socket
+import json
+import time
+import os
+
+import numpy as np
+
+__all__ = ['autotune', 'tuned_settings']
+
+default_chunk_sizes = [4, 8, 16, 32, 64]
+
+# Contents of the cache files already read, by path. They are read only
+# once per process, and updated by autotune().
+_loaded_caches = {}
+
+################################################################################
+
+def default_cache_file():
+    '''
+    Path to the autotuning cache, from the environment variable
+    ``IMFIT_TUNING_CACHE`` or ``~/.imfit/autotune.json``.
+    '''
+    if 'IMFIT_TUNING_CACHE' in os.environ:
+        return os.environ['IMFIT_TUNING_CACHE']
+    return os.path.join(os.path.expanduser('~'), '.imfit', 'autotune.json')
+
+################################################################################
+
+def _cache_key(model_descr, shape, psf, subsampling):
+    # The speed depends on the functions used and on the size of the
+    # images, parameter values are ignored.
+    functions = ','.join(model_descr.functionList())
+    n_sets = len([p for p in model_descr.parameterList() if p.name == 'X0'])
+    psf_shape = 'none' if psf is None else '%dx%d' % np.shape(psf)
+    return '%s;sets=%d;shape=%dx%d;psf=%s;subsampling=%d' % (functions, n_sets, shape[0], shape[1],
+                                                             psf_shape, subsampling)
+
+################################################################################
+
+def _read_cache(cache_file):
+    try:
+        with open(cache_file) as f:
+            cache = json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+    if not isinstance(cache, dict):
+        return {}
+    return cache
+
+################################################################################
+
+def _loaded_cache(cache_file):
+    if cache_file not in _loaded_caches:
+        _loaded_caches[cache_file] = _read_cache(cache_file)
+    return _loaded_caches[cache_file]
+
+################################################################################
+
+def _write_cache(cache_file, cache):
+    cache_dir = os.path.dirname(cache_file)
+    if cache_dir != '' and not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    # Write to a temporary file first, so that concurrent
+    # readers never see a partial file.
+    tmp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+    with open(tmp_file, 'w') as f:
+        json.dump(cache, f, indent=1, sort_keys=True)
+    os.rename(tmp_file, cache_file)
+    _loaded_caches[cache_file] = cache
+
+################################################################################
+
+def tuned_settings(model_descr, shape, psf=None, subsampling=True, cache_file=None):
+    '''
+    Look up the settings found by :func:`autotune` for this host.
+    The cache file is read only once per process, settings stored
+    by other processes afterwards are not seen.
+
+    Parameters
+    ----------
+    model_descr : :class:`~imfit.ModelDescription`
+        The model description.
+
+    shape : tuple
+        Shape of the images, in (Y, X) format.
+
+    psf : 2-D array, optional
+        The PSF, only its shape is used. Default: ``None``.
+
+    subsampling : bool, optional
+        Pixel subsampling flag. Default: ``True``.
+
+    cache_file : string, optional
+        Path to the cache file. Default: see :func:`autotune`.
+
+    Returns
+    -------
+    settings : tuple or None
+        The tuple ``(nproc, chunk_size)``, or ``None`` if this model
+        has not been tuned for images of this shape.
+    '''
+    if cache_file is None:
+        cache_file = default_cache_file()
+    cache = _loaded_cache(cache_file)
+    host_cache = cache.get(socket.gethostname(), {})
+    entry = host_cache.get(_cache_key(model_descr, shape, psf, subsampling))
+    if entry is None:
+        return None
+    return entry['nproc'], entry['chunk_size']
+
+################################################################################
+
+def autotune(model_descr, shape, psf=None, subsampling=True, nproc_values=None,
+             chunk_sizes=None, min_time=0.2, cache_file=None):
+    '''
+    Find the number of threads and OpenMP chunk size that compute
+    the model image fastest, and store them in the cache.
+
+    The model image is computed for every combination of ``nproc_values``
+    and ``chunk_sizes``, repeating it for at least ``min_time`` seconds.
+
+    Parameters
+    ----------
+    model_descr : :class:`~imfit.ModelDescription`
+        The model description.
+
+    shape : tuple
+        Shape of the images, in (Y, X) format.
+
+    psf : 2-D array, optional
+        Point Spread Function image. Default: ``None``.
+
+    subsampling : bool, optional
+        Use pixel subsampling near center. Default: ``True``.
+
+    nproc_values : list of int, optional
+        Number of threads to try.
+        Default: ``None``, powers of two up to the number of processors,
+        and the number of processors.
+
+    chunk_sizes : list of int, optional
+        Chunk sizes to try. Default: ``[4, 8, 16, 32, 64]``.
+
+    min_time : float, optional
+        Minimum time in seconds of each measurement. Default: ``0.2``.
+
+    cache_file : string, optional
+        Path to the cache file. If ``False``, the result is not stored.
+        Default: the path in the environment variable ``IMFIT_TUNING_CACHE``,
+        or ``~/.imfit/autotune.json``.
+
+    Returns
+    -------
+    settings : tuple
+        The tuple ``(nproc, chunk_size)``.
+
+    timings : dict
+        Time to compute a single model image, in seconds, for each
+        ``(nproc, chunk_size)`` tried.
+    '''
+    from .lib import ModelObjectWrapper
+
+    if nproc_values is None:
+        n_cpu = cpu_count()
+        nproc_values = [n for n in [1, 2, 4, 8, 16, 32, 64, 128] if n < n_cpu] + [n_cpu]
+    if chunk_sizes is None:
+        chunk_sizes = default_chunk_sizes
+
+    timings = {}
+    for nproc in nproc_values:
+        model_object = ModelObjectWrapper(model_descr, 0, -1, subsampling)
+        try:
+            if psf is not None:
+                model_object.setPSF(np.asarray(psf))
+            model_object.setMaxThreads(nproc)
+            model_object.setupModelImage(shape)
+            for chunk_size in chunk_sizes:
+                model_object.setChunkSize(chunk_size)
+                count = 1
+                while True:
+                    t1 = time.time()
+                    model_object._testCreateModelImage(count)
+                    elapsed = time.time() - t1
+                    if elapsed >= min_time:
+                        break
+                    count = max(2 * count, int(1.2 * count * min_time / max(elapsed, 1e-6)))
+                timings[(nproc, chunk_size)] = elapsed / count
+        finally:
+            model_object.close()
+
+    settings = min(timings, key=timings.get)
+    if cache_file is not False:
+        if cache_file is None:
+            cache_file = default_cache_file()
+        cache = _read_cache(cache_file)
+        host_cache = cache.setdefault(socket.gethostname(), {})
+        host_cache[_cache_key(model_descr, shape, psf, subsampling)] = {'nproc': settings[0],
+                                                                        'chunk_size': settings[1],
+                                                                        'time': timings[settings]}
+        _write_cache(cache_file, cache)
+    return settings, timings
+
+################################################################################